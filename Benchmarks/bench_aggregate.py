@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# Benchmarks the metadata/shapefile preparation of Geomaps_pie.py as the number of metadata rows grows.
+# Compares the original merge-first preparation (one polygon copy per metadata row) with the aggregate-first one.
+
+__version__ = '0.1'
+__date__ = '18-10-2026'
+
+###### Imports
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+import geopandas as gpd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Codes"))
+from Geomaps_pie import aggregate_metadata, prepare_regions
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Example_files")
+
+
+def parse_args():
+    description = "Benchmark merge-first vs aggregate-first preparation of the map inputs"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--shape_file', default=os.path.join(EXAMPLES, "jam_admbnda_adm1_sdc_20240802_fixed.shp"), help="Path to shape file")
+    parser.add_argument('--metadata_file', default=os.path.join(EXAMPLES, "Jamaica_metadata_test.xlsx"), help="Path to metadata file sampled to build the larger inputs")
+    parser.add_argument('--agg_column', default='Plasmids', help="Aggregation column for pie charts")
+    parser.add_argument('--agg_mapinfo', default='Population', help="Aggregation column for map density")
+    parser.add_argument('--rows', nargs='+', type=int, default=[100, 1000, 10000, 100000, 300000], help="Metadata row counts to benchmark. Small counts give regions with tied category counts, whose order is checked as well")
+    parser.add_argument('--skip_legacy_above', type=int, default=300000, help="Do not run the merge-first preparation above this many rows")
+    return parser.parse_args()
+
+#original preparation: attach the geometry to every metadata row, then reproject and compute points per row
+def merge_first(shape, human_meta, agg_column):
+    shape = shape.merge(human_meta, how="right", on="RGN21NM")
+    shape = shape.dropna(subset=["RGN21NM"])
+    shape = shape.to_crs(epsg=4326)
+
+    shape['coords'] = shape['geometry'].apply(lambda x: x.representative_point().coords[:])
+    shape['coords'] = [coords[0] for coords in shape['coords']]
+    shape["X"], shape["Y"] = zip(*shape["coords"])
+
+    region_agg2 = shape.groupby(["RGN21NM", "X", "Y"])[agg_column].value_counts().to_frame(name="Counts")
+    region_agg2 = region_agg2.reset_index()
+    total_counts = region_agg2.groupby("RGN21NM")["Counts"].sum()
+    region_agg2["Total cases"] = region_agg2["RGN21NM"].map(total_counts)
+    return region_agg2
+
+def aggregate_first(shape, human_meta, agg_column, agg_mapinfo):
+    human_meta = human_meta.dropna(subset=["RGN21NM"])
+    region_counts, region_values = aggregate_metadata(human_meta, agg_column, agg_mapinfo)
+    regions = prepare_regions(shape, region_counts["RGN21NM"].unique())
+    return region_counts.merge(regions[["RGN21NM", "X", "Y"]], on="RGN21NM")
+
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak / 1e6
+
+#the pie counts of both preparations, in the order they come in, as that is the order the pie segments are drawn in
+def same_pies(legacy, new, agg_column):
+    columns = ["RGN21NM", "X", "Y", agg_column, "Counts", "Total cases"]
+    return legacy[columns].reset_index(drop=True).equals(new[columns].reset_index(drop=True))
+
+def main():
+    args = parse_args()
+    shape = gpd.read_file(args.shape_file)
+    sample = pd.read_excel(args.metadata_file)
+
+    print(f"{'rows':>10} {'merge-first s':>14} {'peak MB':>9} {'aggregate-first s':>18} {'peak MB':>9} {'speedup':>8} {'same':>5}")
+    for rows in args.rows:
+        human_meta = sample.sample(n=rows, replace=True, random_state=rows).reset_index(drop=True)
+
+        new, new_time, new_peak = measure(aggregate_first, shape, human_meta, args.agg_column, args.agg_mapinfo)
+        if rows > args.skip_legacy_above:
+            print(f"{rows:>10} {'-':>14} {'-':>9} {new_time:>18.3f} {new_peak:>9.1f} {'-':>8} {'-':>5}")
+            continue
+
+        legacy, legacy_time, legacy_peak = measure(merge_first, shape, human_meta, args.agg_column)
+        print(f"{rows:>10} {legacy_time:>14.3f} {legacy_peak:>9.1f} {new_time:>18.3f} {new_peak:>9.1f} "
+              f"{legacy_time / new_time:>7.1f}x {str(same_pies(legacy, new, args.agg_column)):>5}")
+
+if __name__ == "__main__":
+    main()
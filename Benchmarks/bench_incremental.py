@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# Benchmarks the incremental re-render of MapRenderer: the time to apply a metadata delta touching a growing number of
+# regions and draw the new frame, against recounting the whole metadata and drawing the map again.
+
+__version__ = '0.1'
+__date__ = '18-10-2026'
+
+###### Imports
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from synthetic import synthetic_map
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Codes"))
+from Geomaps_pie import MapRenderer
+
+
+def parse_args():
+    description = "Benchmark the incremental re-render of MapRenderer against a full redraw"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--regions', type=int, default=2500, help="Number of regions of the synthetic map (Voronoi regions from synthetic.py)")
+    parser.add_argument('--rows', type=int, default=50000, help="Number of metadata rows")
+    parser.add_argument('--changed', nargs='+', type=int, default=[1, 10, 100, 1000], help="Number of regions changed by each delta")
+    parser.add_argument('--categories', type=int, default=4, help="Number of pie chart categories")
+    parser.add_argument('--label_style', default=None, help="Label style of the map (style1 adds one text per segment)")
+    parser.add_argument('--choropleth', action='store_true', help="Fill the regions with the Population column as well")
+    parser.add_argument('--dpi', type=float, default=100, help="Resolution of the frames")
+    parser.add_argument('--repeats', type=int, default=3, help="Number of deltas timed for each number of changed regions")
+    return parser.parse_args()
+
+#new rows for n_changed random regions, labelled after the existing rows
+def delta_rows(metadata, n_changed, next_label, rng):
+    regions = rng.choice(metadata["RGN21NM"].unique(), size=n_changed, replace=False)
+    added = metadata[metadata["RGN21NM"].isin(regions)].drop_duplicates("RGN21NM").copy()
+    added.index = pd.RangeIndex(next_label, next_label + len(added))
+    return added
+
+#whether a frame drawn after a delta has the pixels of the map counted and drawn again from its metadata
+def same_as_redraw(renderer, frame):
+    renderer.update_counts(renderer.metadata)
+    return np.array_equal(frame, renderer.draw_frame())
+
+def main():
+    args = parse_args()
+    shape, metadata, colours_dict = synthetic_map(args.regions, args.rows, args.categories)
+    options = {"agg_mapinfo": "Population", "colormap": ["#E7F3FF", "pink"]} if args.choropleth else {}
+    renderer = MapRenderer(shape, metadata, "Category", colours_dict, label_style=args.label_style, dpi=args.dpi, **options)
+
+    start = time.perf_counter()
+    renderer.draw_frame()
+    first_time = time.perf_counter() - start
+
+    full_times = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        renderer.update_counts(metadata)
+        renderer.draw_frame()
+        full_times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    renderer.render()
+    encode_time = time.perf_counter() - start
+
+    print(f"{args.regions} regions, {args.rows} rows, dpi {args.dpi:g}")
+    print(f"{'changed':>8} {'delta s':>8} {'draw s':>8} {'total s':>8} {'same':>5}")
+    print(f"{'first':>8} {'':>8} {first_time:>8.3f} {first_time:>8.3f}")
+    print(f"{'all':>8} {'':>8} {statistics.median(full_times):>8.3f} {statistics.median(full_times):>8.3f}")
+    rng = np.random.default_rng(1)
+    next_label = len(metadata)
+    for n_changed in args.changed:
+        delta_times, draw_times, same = [], [], True
+        for _ in range(args.repeats):
+            added = delta_rows(renderer.metadata, min(n_changed, args.regions), next_label, rng)
+            next_label += len(added)
+            start = time.perf_counter()
+            renderer.apply_delta(added)
+            delta_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            frame = renderer.draw_frame().copy()
+            draw_times.append(time.perf_counter() - start)
+            same = same and same_as_redraw(renderer, frame)
+        delta_time, draw_time = statistics.median(delta_times), statistics.median(draw_times)
+        print(f"{n_changed:>8} {delta_time:>8.3f} {draw_time:>8.3f} {delta_time + draw_time:>8.3f} {str(same):>5}")
+    print(f"PNG encoding of a frame: {encode_time:.3f} s")
+
+if __name__ == "__main__":
+    main()
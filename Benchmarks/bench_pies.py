@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+# Benchmarks the original per-segment draw_pie loop of Geomaps_pie.py against the batched draw_pies renderer.
+# Reports matplotlib artist counts, draw/save times and output sizes for a growing number of regions.
+
+__version__ = '0.1'
+__date__ = '18-10-2026'
+
+###### Imports
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from synthetic import synthetic_map
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import matplotlib.patheffects as PathEffects
+from mpl_toolkits.basemap import Basemap
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Codes"))
+from Geomaps_pie import aggregate_metadata, draw_pies
+
+
+def parse_args():
+    description = "Benchmark the draw_pie loop against the batched draw_pies renderer"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--regions', nargs='+', type=int, default=[50, 500, 5000], help="Number of pie charts to draw")
+    parser.add_argument('--rows_per_region', type=int, default=60, help="Average number of metadata rows of a region, the total of its pie chart")
+    parser.add_argument('--categories', type=int, default=4, help="Number of pie chart categories")
+    parser.add_argument('--label_style', default=None, help="Label style passed to both renderers (style1 adds one text per segment)")
+    parser.add_argument('--file_formats', nargs='+', default=['png', 'svg'], help="Output formats to time savefig for")
+    parser.add_argument('--dpi', type=float, default=100, help="Resolution used for raster formats")
+    return parser.parse_args()
+
+#category counts of a synthetic map, laid out like the region_agg2 table built by MapRenderer
+def synthetic_pie_counts(n_regions, rows_per_region, n_categories):
+    shape, metadata, colours_dict = synthetic_map(n_regions, n_regions * rows_per_region, n_categories)
+    region_counts, _ = aggregate_metadata(metadata, "Category")
+    points = shape.representative_point()
+    regions = pd.DataFrame({"RGN21NM": shape["RGN21NM"], "X": points.x, "Y": points.y})
+    return region_counts.merge(regions, on="RGN21NM"), colours_dict
+
+#function generating pie charts in scatter plot, one scatter per segment, as Geomaps_pie.py drew them before draw_pies
+def draw_pie(dist, xpos, ypos, pie_size, colors, basemap, ax=None, label_style=None, pie_fontsize=10, pie_rotation=25, pie_text_loc=0.17):
+    if ax is None:
+        fig, ax = plt.subplots(figsize=(20, 18))
+    
+    cumsum = np.cumsum(dist)
+    cumsum = cumsum / cumsum[-1]
+    pie = [0] + cumsum.tolist()
+    
+    for r1, r2, color, value in zip(pie[:-1], pie[1:], colors, dist):
+        angles = np.linspace(2 * np.pi * r1, 2 * np.pi * r2, 100)
+        x = [0] + np.cos(angles).tolist()
+        y = [0] + np.sin(angles).tolist()
+        xy = np.column_stack([x, y])
+
+        #calculate the midpoint angle for the section
+        mid_angle = (r1 + r2) * np.pi
+        center_x = xpos + pie_text_loc * np.cos(mid_angle)
+        center_y = ypos + pie_text_loc * np.sin(mid_angle)
+        percentage = value * 100
+
+        #convert center_x and center_y of pie charts to map projection
+        mcx, mcy = basemap(center_x, center_y)
+        
+        #setting markers for style1 of pie charts
+        if label_style == 'style1':
+            t = ax.text(mcx, mcy, f'{percentage:.1f}%', ha='center', va='center', 
+                        fontsize=pie_fontsize, fontweight="bold", color='black', 
+                        rotation=pie_rotation)
+            t.set_path_effects([PathEffects.withStroke(linewidth=5, foreground='w')])
+        
+        # Convert scatter plot xpos and ypos coordinates to map projection
+        mx, my = basemap(xpos, ypos)
+        ax.scatter(mx, my, marker=xy, s=pie_size, color=color, edgecolor='white', alpha=1)
+
+#the loop used by create_map_with_pie_charts before draw_pies
+def draw_with_loop(region_agg2, colours_dict, pie_size, m, ax, label_style):
+    for (region_name, xpos, ypos), group in region_agg2.groupby(["RGN21NM", "X", "Y"]):
+        colors = group["Category"].map(colours_dict).tolist()
+        total_cases = group["Total cases"].iloc[0]
+        dist = [num / total_cases for num in group["Counts"].tolist()]
+        draw_pie(dist, xpos, ypos, total_cases * pie_size, colors, m, ax=ax, label_style=label_style)
+
+def draw_batched(region_agg2, colours_dict, pie_size, m, ax, label_style):
+    draw_pies(region_agg2, "Category", colours_dict, pie_size, m, ax, label_style=label_style)
+
+def run(renderer, region_agg2, colours_dict, args):
+    fig, ax = plt.subplots(figsize=(20, 18))
+    m = Basemap(projection='merc', resolution=None, llcrnrlon=-6, llcrnrlat=49.9, urcrnrlon=2, urcrnrlat=55.9, ax=ax)
+    m.drawmapboundary(linewidth=0)
+
+    start = time.perf_counter()
+    renderer(region_agg2, colours_dict, 1, m, ax, args.label_style)
+    build_time = time.perf_counter() - start
+    artists = len(ax.get_children())
+
+    start = time.perf_counter()
+    fig.canvas.draw()
+    draw_time = time.perf_counter() - start
+
+    saves = {}
+    for file_format in args.file_formats:
+        buffer = io.BytesIO()
+        start = time.perf_counter()
+        fig.savefig(buffer, format=file_format, dpi=args.dpi)
+        saves[file_format] = (time.perf_counter() - start, buffer.tell() / 1e6)
+    plt.close(fig)
+    return artists, build_time, draw_time, saves
+
+def main():
+    args = parse_args()
+    save_header = " ".join(f"{fmt + ' s':>9} {fmt + ' MB':>9}" for fmt in args.file_formats)
+    print(f"{'regions':>8} {'renderer':>9} {'artists':>8} {'build s':>8} {'draw s':>8} {save_header}")
+    for n_regions in args.regions:
+        region_agg2, colours_dict = synthetic_pie_counts(n_regions, args.rows_per_region, args.categories)
+        for name, renderer in [("loop", draw_with_loop), ("batched", draw_batched)]:
+            artists, build_time, draw_time, saves = run(renderer, region_agg2, colours_dict, args)
+            save_cols = " ".join(f"{saves[fmt][0]:>9.2f} {saves[fmt][1]:>9.2f}" for fmt in args.file_formats)
+            print(f"{n_regions:>8} {name:>9} {artists:>8} {build_time:>8.2f} {draw_time:>8.2f} {save_cols}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+# Benchmarks the rendering of whole maps by Geomaps_pie.py on synthetic Voronoi boundaries and metadata.
+# Each scaling input (regions, vertices per region, categories and metadata rows) is grown in turn from a base map, and
+# the base map is rendered with and without a choropleth, in each label style and output format. Every render runs in a
+# new interpreter with --profile, and its stage times, throughput and peak memory are compared with a stored baseline.
+
+__version__ = '0.1'
+__date__ = '18-10-2026'
+
+###### Imports
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+
+import synthetic
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Codes", "Geomaps_pie.py")
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+#inputs of the base map, from which one input at a time is grown
+BASE = {"regions": 400, "vertices": 50, "categories": 4, "rows": 20000}
+
+
+def parse_args():
+    description = "Benchmark the rendering of synthetic maps by Geomaps_pie.py against a stored baseline"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--regions', nargs='+', type=int, default=[100, 400, 1600], help="Numbers of regions of the synthetic maps")
+    parser.add_argument('--vertices', nargs='+', type=int, default=[10, 50, 500], help="Numbers of vertices per region")
+    parser.add_argument('--categories', nargs='+', type=int, default=[2, 4, 12], help="Numbers of pie chart categories")
+    parser.add_argument('--rows', nargs='+', type=int, default=[2000, 20000, 200000], help="Numbers of metadata rows")
+    parser.add_argument('--maps', nargs='+', choices=['simple', 'choropleth'], default=['simple', 'choropleth'], help="Maps rendered from the base inputs: plain colour regions, or filled by the Population column")
+    parser.add_argument('--label_styles', nargs='+', choices=['none', 'style1', 'style2'], default=['none', 'style1', 'style2'], help="Label styles rendered from the base inputs")
+    parser.add_argument('--file_formats', nargs='+', default=['png', 'svg', 'pdf'], help="Output formats rendered from the base inputs")
+    parser.add_argument('--dpi', type=float, default=100, help="Resolution of the maps")
+    parser.add_argument('--map_resolution', default='c', help="Resolution of the background coastlines and borders. The crude default keeps the background, which does not grow with the inputs, from dominating the times")
+    parser.add_argument('--repeats', type=int, default=3, help="Number of renders of each case, of which the median times are kept")
+    parser.add_argument('--baseline', default=BASELINE, help="JSON file of the baseline results")
+    parser.add_argument('--save_baseline', action='store_true', help="Store the results as the new baseline instead of comparing with it")
+    parser.add_argument('--tolerance', type=float, default=1.5, help="Ratio to the baseline above which a time or the peak memory is reported as a regression")
+    parser.add_argument('--min_seconds', type=float, default=0.05, help="Time differences below this are never reported as regressions")
+    parser.add_argument('--output', help="JSON file where the results of this run are written")
+    return parser.parse_args()
+
+#cases of the suite: each scaling input grown from the base map, then the maps, label styles and formats of the base map
+def cases(args):
+    found = {}
+    for name in ["regions", "vertices", "categories", "rows"]:
+        for value in getattr(args, name):
+            found.setdefault(case_name({**BASE, name: value}, 'simple', 'none', 'png'), ({**BASE, name: value}, 'simple', 'none', 'png'))
+    for map_kind in args.maps:
+        for label_style in args.label_styles:
+            for file_format in args.file_formats:
+                found.setdefault(case_name(BASE, map_kind, label_style, file_format), (BASE, map_kind, label_style, file_format))
+    return found
+
+def case_name(inputs, map_kind, label_style, file_format):
+    return (f"regions={inputs['regions']} vertices={inputs['vertices']} categories={inputs['categories']} rows={inputs['rows']} "
+            f"map={map_kind} label_style={label_style} format={file_format}")
+
+#write the synthetic shapefile and metadata of a set of inputs, once for all the cases using them
+def inputs_files(inputs, directory, written):
+    key = tuple(sorted(inputs.items()))
+    if key not in written:
+        shape, metadata, _ = synthetic.synthetic_map(inputs["regions"], inputs["rows"], inputs["categories"], inputs["vertices"])
+        written[key] = synthetic.write_inputs(directory, shape, metadata, name=f"synthetic{len(written)}")
+    return written[key]
+
+#render one case in a new interpreter, returning the --profile report and the size of the map written
+def render(shape_file, metadata_file, inputs, map_kind, label_style, file_format, args, directory):
+    llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat = synthetic.CORNERS
+    report = os.path.join(directory, "report.json")
+    command = [sys.executable, SCRIPT, "--shape_file", shape_file, "--metadata_file", metadata_file,
+               "--agg_column", "Category", "--colours_dict", str(synthetic.colours_dict(inputs["categories"])),
+               f"--llcrnrlon={llcrnrlon}", f"--llcrnrlat={llcrnrlat}", f"--urcrnrlon={urcrnrlon}", f"--urcrnrlat={urcrnrlat}",
+               "--pie_size", "0.5", "--file_format", file_format, "--dpi", str(args.dpi), "--map_resolution", args.map_resolution,
+               "--output_file_prefix", os.path.join(directory, "map"), "--profile", report]
+    if map_kind == 'choropleth':
+        command += ["--agg_mapinfo", "Population", "--colormap", "['#E7F3FF', 'pink']"]
+    if label_style != 'none':
+        command += ["--label_style", label_style]
+
+    result = subprocess.run(command, capture_output=True, text=True, cwd=directory, env={**os.environ, "MPLBACKEND": "Agg"})
+    if result.returncode != 0:
+        raise RuntimeError(f"Geomaps_pie.py failed:\n{result.stderr}")
+    with open(report) as handle:
+        return json.load(handle), os.path.getsize(os.path.join(directory, "map." + file_format))
+
+#median stage and total times of the repeats of a case, the largest peak memory, and the throughput of the median render
+def run_case(inputs, map_kind, label_style, file_format, args, directory, written):
+    shape_file, metadata_file = inputs_files(inputs, directory, written)
+    reports = []
+    for _ in range(args.repeats):
+        report, size = render(shape_file, metadata_file, inputs, map_kind, label_style, file_format, args, directory)
+        reports.append(report)
+
+    stages = {}
+    for name in [record["stage"] for record in reports[0]["stages"]]:
+        stages[name] = statistics.median(record["wall_seconds"] for report in reports for record in report["stages"] if record["stage"] == name)
+    seconds = statistics.median(report["total"]["wall_seconds"] for report in reports)
+    peak = [report["total"]["peak_rss_mb"] for report in reports if report["total"]["peak_rss_mb"] is not None]
+    return {"seconds": seconds, "stages": stages, "peak_rss_mb": max(peak) if peak else None,
+            "regions_per_second": inputs["regions"] / seconds, "rows_per_second": inputs["rows"] / seconds,
+            "vertices_drawn": reports[0]["counts"].get("region_vertices"), "output_bytes": size}
+
+def machine():
+    import geopandas
+    import matplotlib
+    import shapely
+
+    return {"platform": platform.platform(), "processor": platform.processor() or platform.machine(), "python": platform.python_version(),
+            "geopandas": geopandas.__version__, "shapely": shapely.__version__, "matplotlib": matplotlib.__version__}
+
+#times and peak memory of the cases grown beyond the tolerance since the baseline. Differences below min_seconds are ignored
+def regressions(results, baseline, tolerance, min_seconds):
+    found = []
+    for name, result in results.items():
+        if name not in baseline["cases"]:
+            continue
+        reference = baseline["cases"][name]
+        measures = [("total", result["seconds"], reference["seconds"])]
+        measures += [(stage, seconds, reference["stages"][stage]) for stage, seconds in result["stages"].items() if stage in reference["stages"]]
+        for measure, seconds, reference_seconds in measures:
+            if seconds > reference_seconds * tolerance and seconds - reference_seconds > min_seconds:
+                found.append((name, measure, f"{reference_seconds:.3f} s", f"{seconds:.3f} s"))
+        if result["peak_rss_mb"] is not None and reference["peak_rss_mb"] is not None and result["peak_rss_mb"] > reference["peak_rss_mb"] * tolerance:
+            found.append((name, "peak memory", f"{reference['peak_rss_mb']:.0f} MB", f"{result['peak_rss_mb']:.0f} MB"))
+    return found
+
+def main():
+    args = parse_args()
+    results = {}
+    print(f"{'total s':>8} {'merge s':>8} {'pies s':>8} {'fill s':>8} {'save s':>8} {'regions/s':>10} {'rows/s':>10} {'peak MB':>8}  case")
+    with tempfile.TemporaryDirectory() as directory:
+        written = {}
+        for name, (inputs, map_kind, label_style, file_format) in cases(args).items():
+            result = run_case(inputs, map_kind, label_style, file_format, args, directory, written)
+            results[name] = result
+            stages = result["stages"]
+            print(f"{result['seconds']:>8.2f} {stages.get('merge', 0):>8.3f} {stages.get('pie drawing', 0):>8.3f} "
+                  f"{stages.get('choropleth fill', 0):>8.3f} {stages.get('savefig', 0):>8.2f} {result['regions_per_second']:>10.0f} "
+                  f"{result['rows_per_second']:>10.0f} {result['peak_rss_mb'] or 0:>8.0f}  {name}", flush=True)
+
+    run = {"machine": machine(), "dpi": args.dpi, "map_resolution": args.map_resolution, "repeats": args.repeats, "cases": results}
+    if args.output is not None:
+        with open(args.output, 'w') as handle:
+            json.dump(run, handle, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as handle:
+            json.dump(run, handle, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"No baseline found at {args.baseline}, run with --save_baseline to store one.")
+        return
+
+    with open(args.baseline) as handle:
+        baseline = json.load(handle)
+    if baseline["machine"] != run["machine"] or (baseline["dpi"], baseline["map_resolution"]) != (args.dpi, args.map_resolution):
+        print("The baseline was recorded on another machine, environment or settings: compare its times with care.")
+    found = regressions(results, baseline, args.tolerance, args.min_seconds)
+    compared = len(set(results) & set(baseline["cases"]))
+    if not found:
+        print(f"No regressions beyond {args.tolerance:g} times the baseline in {compared} cases.")
+        return
+    print(f"{len(found)} regressions beyond {args.tolerance:g} times the baseline:")
+    for name, measure, before, after in found:
+        print(f"  {measure}: {before} -> {after}  {name}")
+    sys.exit(1)
+
+if __name__ == "__main__":
+    main()
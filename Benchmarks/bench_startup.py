@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# Benchmarks the cold start of Geomaps_pie.py: importing the module, printing --help and failing on an invalid input.
+# Each case runs in a new interpreter, and the heavy packages loaded by each case are listed.
+
+__version__ = '0.1'
+__date__ = '18-10-2026'
+
+###### Imports
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+CODES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Codes")
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Example_files")
+
+#packages that take a noticeable time to import
+HEAVY_MODULES = ['pandas', 'geopandas', 'shapely', 'pyproj', 'fiona', 'matplotlib', 'matplotlib.pyplot', 'mpl_toolkits.basemap', 'plotly']
+
+
+def parse_args():
+    description = "Benchmark the start up time of Geomaps_pie.py"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--script', default=os.path.join(CODES, "Geomaps_pie.py"), help="Path to the Geomaps_pie.py script to benchmark")
+    parser.add_argument('--repeats', type=int, default=5, help="Number of runs of each case")
+    return parser.parse_args()
+
+#python code run for each case, printing the heavy modules loaded once the case has finished or failed
+def cases(script):
+    script_dir = os.path.dirname(os.path.abspath(script))
+    module = os.path.splitext(os.path.basename(script))[0]
+    report = f"print('loaded:' + ','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    invalid_run = ["--shape_file", "missing.shp", "--metadata_file", os.path.join(EXAMPLES, "Jamaica_metadata_test.xlsx"),
+                   "--agg_column", "Plasmids", "--colours_dict", "{'InCP': 'deeppink'}"]
+    return [
+        ("import", f"import sys; sys.path.insert(0, {script_dir!r}); import {module}; {report}"),
+        ("--help", f"import sys, runpy; sys.argv = [{script!r}, '--help']; sys.path.insert(0, {script_dir!r})\n"
+                   f"try:\n    runpy.run_path({script!r}, run_name='__main__')\nexcept BaseException:\n    pass\n{report}"),
+        ("invalid input", f"import sys, runpy; sys.argv = [{script!r}] + {invalid_run!r}; sys.path.insert(0, {script_dir!r})\n"
+                          f"try:\n    runpy.run_path({script!r}, run_name='__main__')\nexcept BaseException:\n    pass\n{report}"),
+    ]
+
+def run_case(code):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=CODES)
+    elapsed = time.perf_counter() - start
+    loaded = [line[len("loaded:"):] for line in result.stdout.splitlines() if line.startswith("loaded:")]
+    return elapsed, loaded[-1] if loaded else ""
+
+def main():
+    args = parse_args()
+    print(f"{'case':>14} {'median s':>9} {'min s':>7}  heavy modules loaded")
+    for name, code in cases(args.script):
+        times = []
+        loaded = ""
+        for _ in range(args.repeats):
+            elapsed, loaded = run_case(code)
+            times.append(elapsed)
+        print(f"{name:>14} {statistics.median(times):>9.2f} {min(times):>7.2f}  {loaded or '-'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Synthetic inputs for the Geomaps_pie.py benchmarks.
+# Builds boundary sets of Voronoi regions tiling the map, with a configurable number of regions and vertices per region,
+# and metadata tables with a configurable number of rows and categories spread over the regions.
+
+__version__ = '0.1'
+__date__ = '18-10-2026'
+
+###### Imports
+import os
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import MultiPoint, Polygon, box
+from shapely.ops import voronoi_diagram
+
+#default map of Geomaps_pie.py
+CORNERS = (-6, 49.9, 2, 55.9)
+
+#colours of the pie chart categories, repeated when there are more categories
+PALETTE = ["yellow", "deeppink", "#00DD08", "darkturquoise", "orange", "purple",
+           "#1F77B4", "#8C564B", "#BCBD22", "#7F7F7F", "#17BECF", "#E377C2"]
+
+
+#Voronoi cells of random points over the map, named region00000, region00001, ... Each cell outline is densified to about
+#vertices points and bent by a smooth displacement of the whole map, so neighbouring regions still share their borders
+def voronoi_regions(n_regions, vertices=None, corners=CORNERS, seed=0):
+    rng = np.random.default_rng(seed)
+    llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat = corners
+    points = np.column_stack([rng.uniform(llcrnrlon, urcrnrlon, n_regions), rng.uniform(llcrnrlat, urcrnrlat, n_regions)])
+    bounding_box = box(*corners)
+    cells = [cell.intersection(bounding_box) for cell in voronoi_diagram(MultiPoint(points), envelope=bounding_box).geoms]
+
+    if vertices is not None:
+        spacing = np.sqrt(bounding_box.area / n_regions)
+        cells = [bend(densify(cell, vertices), spacing, seed) for cell in cells]
+    names = [f"region{region:05d}" for region in range(len(cells))]
+    return gpd.GeoDataFrame({"RGN21NM": names}, geometry=cells, crs="EPSG:4326")
+
+#outline with each edge split into equal parts, so the outline has at least the given number of vertices
+def densify(cell, vertices):
+    ring = np.asarray(cell.exterior.coords)
+    parts = max(1, int(np.ceil(vertices / (len(ring) - 1))))
+    steps = np.arange(parts) / parts
+    start, end = ring[:-1], ring[1:]
+    #points of both cells sharing an edge are the same, whichever direction the edge is walked
+    outline = (start[:, None, :] + steps[None, :, None] * (end - start)[:, None, :]).reshape(-1, 2)
+    return Polygon(outline)
+
+#move every vertex by the same smooth function of its position. The displacement changes slower than the position
+#(the sum of amplitude times frequency stays below one), so the outlines become irregular without crossing each other
+def bend(cell, spacing, seed=0):
+    rng = np.random.default_rng(seed)
+    x, y = np.asarray(cell.exterior.coords).T
+    dx, dy = np.zeros_like(x), np.zeros_like(y)
+    for octave in range(3):
+        frequency = 2 * np.pi * 4 ** octave / spacing
+        amplitude = 0.3 / frequency
+        phase_x, phase_y = rng.uniform(0, 2 * np.pi, 2)
+        dx += amplitude * np.sin(frequency * y + phase_x)
+        dy += amplitude * np.sin(frequency * x + phase_y)
+    return Polygon(np.column_stack([x + dx, y + dy]))
+
+#metadata rows spread randomly over the regions, with categories drawn with decreasing frequencies and a value per region
+def synthetic_metadata(region_names, n_rows, n_categories, seed=0):
+    rng = np.random.default_rng(seed)
+    region_names = np.asarray(region_names)
+    categories = [f"cat{i}" for i in range(n_categories)]
+    weights = 1 / np.arange(1, n_categories + 1)
+    region_value = rng.integers(1000, 100000, size=len(region_names))
+    region = rng.integers(0, len(region_names), size=n_rows)
+    return pd.DataFrame({"RGN21NM": region_names[region], "Category": rng.choice(categories, size=n_rows, p=weights / weights.sum()),
+                         "Population": region_value[region]})
+
+def colours_dict(n_categories):
+    return {f"cat{i}": PALETTE[i % len(PALETTE)] for i in range(n_categories)}
+
+#boundaries, metadata and pie chart colours of a synthetic map, as used by the benchmarks
+def synthetic_map(n_regions, n_rows, n_categories, vertices=None, corners=CORNERS, seed=0):
+    shape = voronoi_regions(n_regions, vertices, corners, seed)
+    metadata = synthetic_metadata(shape["RGN21NM"], n_rows, n_categories, seed)
+    return shape, metadata, colours_dict(n_categories)
+
+#write the boundaries as a shapefile and the metadata as csv in a directory, returning the paths of both files
+def write_inputs(directory, shape, metadata, name="synthetic"):
+    shape_file = os.path.join(directory, name + ".shp")
+    metadata_file = os.path.join(directory, name + ".csv")
+    shape.to_file(shape_file)
+    metadata.to_csv(metadata_file, index=False)
+    return shape_file, metadata_file
@@ -4,41 +4,46 @@ __version__ = '1.0'
 __date__ = '02-09-2024'
 __author__ = 'E.F.Fotopoulou'
 
-import pandas as pd
+#pandas, geopandas, shapely, matplotlib and Basemap are imported by the functions using them,
+#so that --help and the validation of the arguments and inputs do not wait for them
 import numpy as np
-import geopandas as gpd
 import os
-
-from mpl_toolkits.basemap import Basemap
-import plotly.express as px
-import fiona
-from shapely.geometry import MultiPolygon, Polygon
-
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
-import matplotlib.cm as cm
-import matplotlib.patheffects as PathEffects
-import matplotlib.lines as mlines
-from matplotlib.colors import LinearSegmentedColormap, Normalize
+import copy
+import functools
+import io
 
 import argparse
 import ast
+import json
+import sys
+import multiprocessing
+import cProfile
 
 import time
-import progressbar
+
+import map_cache
+import map_profile
 
 import warnings
-warnings.simplefilter(action='ignore', category=FutureWarning)
 
-def parse_args():
+#essential parameters, required on the command line unless they are set by the jobs of a --jobs file
+REQUIRED_ARGS = ['shape_file', 'metadata_file', 'agg_column', 'colours_dict']
+
+#size of the map figures, in inches
+FIGSIZE = (20, 18)
+
+#resolutions of the Basemap coastline and country border datasets, from crude to full
+MAP_RESOLUTIONS = ['c', 'l', 'i', 'h', 'f']
+
+def build_parser():
     description = "Map creation with pie charts"
     parser = argparse.ArgumentParser(description=description)
     
     #essential parameters
-    parser.add_argument('--shape_file', required=True, help="Path to shape file")
-    parser.add_argument('--metadata_file', required=True, help="Path to metadata file")
-    parser.add_argument('--agg_column', required=True, help="Aggregation column for pie charts")
-    parser.add_argument('--colours_dict', required=True, type=str, help="Colours dictionary for pie charts")
+    parser.add_argument('--shape_file', help="Path to shape file")
+    parser.add_argument('--metadata_file', help="Path to metadata file (.xlsx, .csv, .tsv, .parquet or .feather)")
+    parser.add_argument('--agg_column', help="Aggregation column for pie charts")
+    parser.add_argument('--colours_dict', type=str, help="Colours dictionary for pie charts")
 
     #parameters for maps outside England
     parser.add_argument('--llcrnrlon', type=float, default=-6, help="Lower left corner longitude of the map")
@@ -73,28 +78,139 @@ def parse_args():
 
     #paramenters for outout file save
     parser.add_argument('--output_file_prefix', default='Output_map', help="Title of the output map file. Omit file format extension. (eg 'Figure01' not 'Figure01.png')")
-    parser.add_argument('--file_format', default='png', help="Format type for output figure. Default is png. Options: png,jpeg,svg,pdf")
+    parser.add_argument('--file_format', default='png', help="Format type for output figure. Default is png. Options: png,jpeg,svg,pdf. Several formats can be given separated by commas (eg. png,pdf)")
     parser.add_argument('--dpi', type=float, default=300, help="Figure resolution in dots per inch. Default is 300")
 
-    args = parser.parse_args()
+    #parameters for the region geometry
+    parser.add_argument('--clip_to_bbox', action='store_true', help="Flag for clipping the regions crossing the map edges to the map coordinates, so their vertices outside the map are not projected and drawn")
+    parser.add_argument('--map_resolution', default='i', choices=MAP_RESOLUTIONS + ['auto'], help="Resolution of the coastline and country border datasets: c (crude), l (low), i (intermediate), h (high), f (full), or auto to pick coarser datasets for larger maps. Default is i")
+    parser.add_argument('--simplify', nargs='?', type=float, const=0.5, default=None, help="Simplify the region outlines to a tolerance given in output pixels, worked out from the map coordinates, the figure size and --dpi. Default when the flag is given without a value is 0.5")
+
+    #parameters for reading the metadata file
+    parser.add_argument('--xlsx_to_parquet', action='store_true', help="Flag for converting an excel metadata file to parquet once, next to the source file (<metadata_file>.parquet), and reading the parquet file on this and later runs. Requires pyarrow")
+
+    #parameters for the cache of prepared boundaries
+    parser.add_argument('--cache_dir', default=None, help="Directory caching the reprojected and projected shapefile geometry between runs. Default: no cache")
+    parser.add_argument('--cache_max_mb', type=float, default=1024, help="Maximum size of the cache directory in MB. Least recently used entries are removed first. Default is 1024")
+    parser.add_argument('--no_cache', action='store_true', help="Flag for ignoring the cache directory for this run (nothing is read from or written to it)")
+    parser.add_argument('--clear_cache', action='store_true', help="Flag for removing all entries of the cache directory before the run")
+
+    #parameters for batch mode
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes rendering the maps of --jobs, or the file formats of a single map, in parallel. Default is 1")
+    parser.add_argument('--profile', default=None, help="Write a report of the wall time, CPU time and peak memory of each stage of the run, with the number of artists and vertices drawn, to this file. JSON, or CSV when the file name ends with .csv")
+    parser.add_argument('--profile_stats', default=None, help="Write cProfile statistics of the run to this file, to be read with pstats or snakeviz")
+    parser.add_argument('--jobs', default=None, help="JSON (or YAML, with PyYAML installed) file with a list of parameter sets, one per map, using the argument names above (eg. [{\"agg_column\": \"Plasmids\", \"output_file_prefix\": \"map1\"}]). Arguments given on the command line are used as defaults for every job. All maps are rendered in one process, sharing the input files, Basemap instances and background layers")
+    return parser
+
+#convert the arguments given as python literals
+def convert_args(args):
     # Convert the colours_dict string to an actual dictionary
-    args.colours_dict = ast.literal_eval(args.colours_dict)
+    if isinstance(args.colours_dict, str):
+        args.colours_dict = ast.literal_eval(args.colours_dict)
 
-    
     # Convert colormap to a list if it’s a string that represents a list
-    try:
-        args.colormap = ast.literal_eval(args.colormap)
-        if not isinstance(args.colormap, list):
-            raise ValueError
-    except (ValueError, SyntaxError):
-        # If it's not a list, keep it as a string (for standard colormaps)
-        pass
+    if isinstance(args.colormap, str):
+        try:
+            args.colormap = ast.literal_eval(args.colormap)
+            if not isinstance(args.colormap, list):
+                raise ValueError
+        except (ValueError, SyntaxError):
+            # If it's not a list, keep it as a string (for standard colormaps)
+            pass
 
     return args
 
+def parse_args():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    missing = [f"--{name}" for name in REQUIRED_ARGS if getattr(args, name) is None]
+    if missing and args.jobs is None:
+        parser.error("the following arguments are required: " + ", ".join(missing))
+    if (args.profile is not None or args.profile_stats is not None) and args.workers > 1:
+        parser.error("--profile and --profile_stats record a single process, they can not be used with --workers")
+
+    return convert_args(args)
+
+#read a job file into one argument set per map, on top of the command line arguments
+def load_jobs(jobs_file, defaults):
+    with open(jobs_file) as handle:
+        if jobs_file.endswith(('.yml', '.yaml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("YAML job files require the PyYAML package. Please install it or provide the jobs as JSON.")
+            spec = yaml.safe_load(handle)
+        else:
+            spec = json.load(handle)
+
+    #either a list of jobs, or {"defaults": {...}, "jobs": [...]}
+    shared = {}
+    if isinstance(spec, dict):
+        shared = spec.get("defaults", {})
+        spec = spec.get("jobs", [])
+    if not isinstance(spec, list) or not spec:
+        raise ValueError("The jobs file must contain a non-empty list of jobs.")
+
+    jobs = []
+    for number, job in enumerate(spec, 1):
+        unknown = (set(shared) | set(job)) - set(vars(defaults))
+        if unknown:
+            raise ValueError(f"Unknown parameters in job {number}: {sorted(unknown)}")
+        args = argparse.Namespace(**{**vars(defaults), **shared, **job, "jobs": None})
+        missing = [name for name in REQUIRED_ARGS if getattr(args, name) is None]
+        if missing:
+            raise ValueError(f"Job {number} is missing the parameters: {missing}")
+        jobs.append(convert_args(args))
+    return jobs
+
 def main():
     args = parse_args()
-    
+    warnings.simplefilter(action='ignore', category=FutureWarning)
+
+    if args.profile is not None:
+        map_profile.start()
+    profiler = None
+    if args.profile_stats is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    #the report is also written when some jobs of a batch failed
+    try:
+        run(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile_stats)
+        if args.profile is not None:
+            map_profile.write_report(args.profile)
+
+#render the map, or the maps of the --jobs file
+def run(args):
+    import progressbar
+
+    if args.clear_cache and args.cache_dir is not None:
+        map_cache.clear_cache(args.cache_dir)
+
+    if args.jobs is not None or args.workers > 1:
+        jobs = load_jobs(args.jobs, args) if args.jobs is not None else [args]
+        bar = progressbar.ProgressBar().start()
+        if args.workers > 1:
+            results = render_jobs_parallel(jobs, args.workers)
+        else:
+            results = render_jobs(jobs)
+        bar.finish()
+        failed = [result for result in results if result["error"] is not None]
+        if failed:
+            sys.exit(f"{len(failed)} of {len(results)} jobs failed.")
+        return
+
+    #the input files and colours are checked before the progress bar starts and the geospatial packages load
+    check_options(args.label_style, args.file_format)
+    check_inputs(args.shape_file, args.metadata_file, args.colours_dict, args.colormap)
+
+    #start progress bar
+    bar = progressbar.ProgressBar().start()
     create_map_with_pie_charts(args.shape_file, args.metadata_file, args.agg_column, args.colours_dict,
                                 args.agg_mapinfo, args.plainmapcol,
                                 args.pie_size, args.simple_map_boundaries,
@@ -104,46 +220,1222 @@ def main():
                                 args.llcrnrlon, args.llcrnrlat, args.urcrnrlon, args.urcrnrlat,
                                 args.output_file_prefix, args.file_format, args.dpi,
                                 args.legend_bbox_to_anchor,
-                                args.pie_text_loc)
+                                args.pie_text_loc,
+                                None if args.no_cache else args.cache_dir, args.cache_max_mb,
+                                args.xlsx_to_parquet, args.clip_to_bbox, args.simplify, args.map_resolution)
 
-#function generating pie charts in scatter plot
-def draw_pie(dist, xpos, ypos, pie_size, colors, basemap, ax=None, label_style=None, pie_fontsize=10, pie_rotation=25, pie_text_loc=0.17):
-    if ax is None:
-        fig, ax = plt.subplots(figsize=(20, 18))
-    
-    total = np.sum(dist)
-    cumsum = np.cumsum(dist)
-    cumsum = cumsum / cumsum[-1]
-    pie = [0] + cumsum.tolist()
-    
-    for r1, r2, color, value in zip(pie[:-1], pie[1:], colors, dist):
-        angles = np.linspace(2 * np.pi * r1, 2 * np.pi * r2, 100)
-        x = [0] + np.cos(angles).tolist()
-        y = [0] + np.sin(angles).tolist()
-        xy = np.column_stack([x, y])
-
-        #calculate the midpoint angle for the section
-        mid_angle = (r1 + r2) * np.pi
-        center_x = xpos + pie_text_loc * np.cos(mid_angle)
-        center_y = ypos + pie_text_loc * np.sin(mid_angle)
-        percentage = value * 100
-
-        #convert center_x and center_y of pie charts to map projection
-        mcx, mcy = basemap(center_x, center_y)
-        
-        #setting markers for style1 of pie charts
-        if label_style == 'style1':
-            t = ax.text(mcx, mcy, f'{percentage:.1f}%', ha='center', va='center', 
-                        fontsize=pie_fontsize, fontweight="bold", color='black', 
-                        rotation=pie_rotation)
+   #finish progress bar 
+    bar.finish()
+
+#marker path of a pie segment spanning the fractions r1 to r2 of the circle, built the same way as the original per-segment
+#draw_pie (kept in Benchmarks/bench_pies.py).
+#The cache is bounded, as a long-lived MapRenderer meets new fractions with every count update
+@functools.lru_cache(maxsize=4096)
+def wedge_marker(r1, r2):
+    from matplotlib.markers import MarkerStyle
+
+    angles = np.linspace(2 * np.pi * r1, 2 * np.pi * r2, 100)
+    xy = np.column_stack([np.concatenate([[0], np.cos(angles)]), np.concatenate([[0], np.sin(angles)])])
+    marker = MarkerStyle(xy)
+    return marker.get_path().transformed(marker.get_transform())
+
+#segments of every pie, ordered pie by pie and keeping the order of the categories within each pie: their region, projected
+#centre, marker size, colour, marker path and fraction of the pie, and the projected position of their style1 label
+def pie_segments(region_agg2, agg_column, colours_dict, pie_size, basemap, pie_text_loc=0.17):
+    pie_id = region_agg2.groupby(["RGN21NM", "X", "Y"]).ngroup().to_numpy()
+    order = np.argsort(pie_id, kind="stable")
+    pie_id = pie_id[order]
+    counts = region_agg2["Counts"].to_numpy()[order]
+    total_cases = region_agg2["Total cases"].to_numpy()[order]
+    xpos = region_agg2["X"].to_numpy()[order]
+    ypos = region_agg2["Y"].to_numpy()[order]
+
+    starts = np.flatnonzero(np.concatenate([[True], pie_id[1:] != pie_id[:-1]]))
+    ends = np.concatenate([starts[1:], [len(pie_id)]])
+
+    dist = counts / total_cases
+    r2 = np.empty(len(dist))
+    for start, end in zip(starts, ends):
+        cumsum = np.cumsum(dist[start:end])
+        r2[start:end] = cumsum / cumsum[-1]
+    r1 = np.concatenate([[0], r2[:-1]])
+    r1[starts] = 0
+
+    #convert all the pie centres to map projection at once
+    mx, my = basemap(xpos[starts], ypos[starts])
+    mid_angle = (r1 + r2) * np.pi
+    label_x, label_y = basemap(xpos + pie_text_loc * np.cos(mid_angle), ypos + pie_text_loc * np.sin(mid_angle))
+    return {"region": region_agg2["RGN21NM"].to_numpy()[order],
+            "x": np.repeat(np.asarray(mx), ends - starts), "y": np.repeat(np.asarray(my), ends - starts),
+            "size": total_cases * pie_size, "colour": region_agg2[agg_column].map(colours_dict).to_numpy()[order],
+            "path": [wedge_marker(a, b) for a, b in zip(r1, r2)], "dist": dist,
+            "label_x": np.asarray(label_x), "label_y": np.asarray(label_y)}
+
+#percentage labels of the segments (style1), as (region, x, y, text) tuples
+def pie_label_specs(segments):
+    return [(region, x, y, f'{value * 100:.1f}%')
+            for region, x, y, value in zip(segments["region"], segments["label_x"], segments["label_y"], segments["dist"])]
+
+#draw the percentage labels of the segments, returning them as (region, text) pairs
+def draw_pie_labels(ax, specs, pie_fontsize=10, pie_rotation=25):
+    import matplotlib.patheffects as PathEffects
+
+    labels = []
+    for region, x, y, label in specs:
+        t = ax.text(x, y, label, ha='center', va='center', 
+                    fontsize=pie_fontsize, fontweight="bold", color='black', 
+                    rotation=pie_rotation)
+        t.set_path_effects([PathEffects.withStroke(linewidth=5, foreground='w')])
+        labels.append((region, t))
+    return labels
+
+#batched version of the original draw_pie loop: every segment of every pie is drawn by a single scatter collection.
+#In svg files each segment is then written in page coordinates rather than as a marker placed at the centre of its pie
+#(shared by identical segments), which makes them larger than with draw_pie, the more so with many pies; pdf files keep
+#the same size.
+#Returns the collection and the (region, text) pairs of the style1 labels
+def draw_pies(region_agg2, agg_column, colours_dict, pie_size, basemap, ax, label_style=None, pie_fontsize=10, pie_rotation=25, pie_text_loc=0.17):
+    if region_agg2.empty:
+        return None, []
+
+    segments = pie_segments(region_agg2, agg_column, colours_dict, pie_size, basemap, pie_text_loc)
+    paths = segments["path"]
+    pies = ax.scatter(segments["x"], segments["y"], marker=paths[0], s=segments["size"], color=list(segments["colour"]), edgecolor='white', alpha=1)
+    pies.set_paths(paths)
+
+    #setting markers for style1 of pie charts
+    labels = []
+    if label_style == 'style1':
+        labels = draw_pie_labels(ax, pie_label_specs(segments), pie_fontsize, pie_rotation)
+    return pies, labels
+
+#total count labels of the pies (style2), as (region, x, y, text) tuples
+def total_label_specs(region_agg2, basemap):
+    region_totals = region_agg2.groupby(["RGN21NM", "X", "Y"])["Total cases"].first().reset_index()
+    tx, ty = basemap(region_totals["X"].to_numpy(), region_totals["Y"].to_numpy())
+    return [(region, x, y, 'n= {}'.format(total_cases))
+            for region, total_cases, x, y in zip(region_totals["RGN21NM"], region_totals["Total cases"], tx, ty)]
+
+#draw the total count labels of the pies, returning them as (region, text) pairs
+def draw_totals(ax, specs, simple_map, pie_fontsize=15):
+    import matplotlib.patheffects as PathEffects
+
+    labels = []
+    for region, x, y, label in specs:
+        if simple_map:
+            t = ax.annotate(label, (x, y),
+                            color='black', fontsize=20, fontweight="bold",
+                            path_effects=[PathEffects.withStroke(linewidth=5, foreground='w')])
+        else:
+            t = ax.annotate(label, (x, y), fontsize=pie_fontsize, color="black", weight="black")
             t.set_path_effects([PathEffects.withStroke(linewidth=5, foreground='w')])
-        
-        # Convert scatter plot xpos and ypos coordinates to map projection
-        mx, my = basemap(xpos, ypos)
-        ax.scatter(mx, my, marker=xy, s=pie_size, color=color, edgecolor='white', alpha=1)
+        labels.append((region, t))
+    return labels
+
+#reduce metadata rows (one per isolate) to per region pie counts and choropleth values
+def aggregate_metadata(human_meta, agg_column, agg_mapinfo=None):
+    region_counts = human_meta.groupby(["RGN21NM", agg_column], observed=True, sort=False).size().to_frame(name="Counts")
+    region_counts = region_counts.reset_index()
+
+    #same order as value_counts in the pinned pandas 2.2: regions sorted, then categories by decreasing count, tied
+    #counts by category (in the order of the categories for a categorical column)
+    region_counts = region_counts.sort_values(["RGN21NM", "Counts", agg_column], ascending=[True, False, True], kind="stable").reset_index(drop=True)
+
+    total_counts = region_counts.groupby("RGN21NM")["Counts"].sum()
+    region_counts["Total cases"] = region_counts["RGN21NM"].map(total_counts)
+
+    #the choropleth used to repaint each region once per metadata row, so the last value of a region is the one shown
+    region_values = None
+    if agg_mapinfo is not None:
+        region_values = human_meta.drop_duplicates(subset="RGN21NM", keep="last").set_index("RGN21NM")[agg_mapinfo]
+
+    return region_counts, region_values
+
+#keep the shapefile regions found in the metadata, reproject them and compute their representative points
+def prepare_regions(shape, region_names):
+    shape = shape.loc[shape["RGN21NM"].isin(region_names), ["RGN21NM", "geometry"]]
+
+    #reformating projection of shape file (requires fiona library)
+    with map_profile.stage("reprojection"):
+        shape = shape.to_crs(epsg=4326)
+
+    with map_profile.stage("representative points"):
+        points = shape.geometry.representative_point()
+        shape["X"] = points.x
+        shape["Y"] = points.y
+    return shape
+
+#polygons making up a geometry. Clipping can also leave lines and points on the map edges, which are not drawn
+def polygon_parts(geom):
+    from shapely.geometry import GeometryCollection, MultiPolygon, Polygon
+
+    if isinstance(geom, Polygon):
+        return [] if geom.is_empty else [geom]
+    if isinstance(geom, (MultiPolygon, GeometryCollection)):
+        return [poly for part in geom.geoms for poly in polygon_parts(part)]
+    return []
+
+#split the region geometries into rings and project all their vertices with a single Basemap call
+def project_region_rings(geometries, basemap):
+    from shapely.geometry.polygon import orient
+
+    rings = []
+    ring_region = []
+    for region, geom in enumerate(geometries):
+        for poly in polygon_parts(geom):
+            #exterior counter-clockwise and holes clockwise, so the holes are left unfilled
+            poly = orient(poly, sign=1.0)
+            for ring in [poly.exterior, *poly.interiors]:
+                rings.append(np.asarray(ring.coords)[:, :2])
+                ring_region.append(region)
+
+    if not rings:
+        return np.empty((0, 2)), np.zeros(1, dtype=int), np.empty(0, dtype=int)
+
+    lonlat = np.concatenate(rings)
+    mx, my = basemap(lonlat[:, 0], lonlat[:, 1])
+    ring_offsets = np.concatenate([[0], np.cumsum([len(ring) for ring in rings])])
+    return np.column_stack([mx, my]), ring_offsets, np.asarray(ring_region)
+
+#Mercator projection of the map, without the coastline datasets (only used to project coordinates)
+def map_projection(llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat):
+    from mpl_toolkits.basemap import Basemap
+
+    return Basemap(projection='merc', resolution=None, llcrnrlon=llcrnrlon, llcrnrlat=llcrnrlat, urcrnrlon=urcrnrlon, urcrnrlat=urcrnrlat)
+
+#simplification tolerance in degrees matching a number of output pixels, for the map drawn on a FIGSIZE figure at dpi
+def simplify_tolerance(pixels, basemap, llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat, dpi):
+    from matplotlib import rcParams
+
+    #the map keeps its aspect ratio, so it fills the axes along one side only
+    axes_width = FIGSIZE[0] * dpi * (rcParams["figure.subplot.right"] - rcParams["figure.subplot.left"])
+    axes_height = FIGSIZE[1] * dpi * (rcParams["figure.subplot.top"] - rcParams["figure.subplot.bottom"])
+    map_width = basemap.urcrnrx - basemap.llcrnrx
+    map_height = basemap.urcrnry - basemap.llcrnry
+    pixel_fraction = max(1 / axes_width, map_height / map_width / axes_height)
+
+    #a pixel spans a fixed number of longitude degrees on the Mercator map, but fewer latitude degrees towards the poles
+    return pixels * (urcrnrlon - llcrnrlon) * pixel_fraction * np.cos(np.radians(max(abs(llcrnrlat), abs(urcrnrlat))))
+
+#reproject the regions, keep the ones within the bounding box and project their outlines, as plain arrays
+def prepare_boundaries(shape, region_names, basemap, llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat,
+                       clip_to_bbox=False, tolerance=None):
+    from shapely.geometry import box
+
+    shape = prepare_regions(shape, region_names)
+
+    with map_profile.stage("bbox query and simplification"):
+        #regions outside the map are dropped with a spatial index query against the bounding box
+        bounding_box = box(llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat)
+        in_view = np.sort(shape.sindex.query(bounding_box, predicate="intersects"))
+        shape = shape.iloc[in_view]
+
+        #the representative points were computed from the full geometries, so the pie charts stay in place
+        geometries = shape.geometry
+        if clip_to_bbox:
+            geometries = geometries.copy()
+            partial = ~geometries.within(bounding_box)
+            geometries[partial] = geometries[partial].intersection(bounding_box)
+        if tolerance is not None:
+            geometries = geometries.simplify(tolerance, preserve_topology=True)
+
+    with map_profile.stage("projection"):
+        vertices, ring_offsets, ring_region = project_region_rings(geometries, basemap)
+    return {"RGN21NM": shape["RGN21NM"].to_numpy(dtype=str), "X": shape["X"].to_numpy(), "Y": shape["Y"].to_numpy(),
+            "vertices": vertices, "ring_offsets": ring_offsets, "ring_region": ring_region}
+
+#read the boundaries file: a shapefile, or a FlatGeobuf or GeoParquet file written by fix_shapefile.py.
+#With the map corners, only the features of a FlatGeobuf file within the map are read, using its spatial index
+def read_shapefile(shape_file, corners=None):
+    import geopandas as gpd
+
+    with map_profile.stage("shapefile read"):
+        extension = os.path.splitext(shape_file)[1].lower()
+        if extension == ".parquet":
+            try:
+                return gpd.read_parquet(shape_file)
+            except ImportError:
+                raise ValueError("Reading GeoParquet boundaries requires the pyarrow package.")
+        if extension == ".fgb" and corners is not None:
+            from shapely.geometry import Polygon
+
+            #the edges of the map are densified, so the box still covers the map once reprojected to the crs of the file
+            llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat = corners
+            lons = np.linspace(llcrnrlon, urcrnrlon, 50)
+            lats = np.linspace(llcrnrlat, urcrnrlat, 50)
+            outline = (list(zip(lons, [llcrnrlat] * 50)) + list(zip([urcrnrlon] * 50, lats)) +
+                       list(zip(lons[::-1], [urcrnrlat] * 50)) + list(zip([llcrnrlon] * 50, lats[::-1])))
+            return gpd.read_file(shape_file, bbox=gpd.GeoSeries([Polygon(outline)], crs="EPSG:4326"))
+        return gpd.read_file(shape_file)
+
+#prepared boundaries of the shapefile (all regions when region_names is None), read from the cache directory when an entry for the same file and map exists.
+#shape_file can also be a GeoDataFrame already read, which is prepared without the cache
+def load_boundaries(shape_file, region_names, llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat, cache_dir=None, cache_max_mb=1024,
+                    clip_to_bbox=False, simplify=None, dpi=300):
+    basemap = map_projection(llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat)
+    tolerance = None
+    if simplify is not None:
+        tolerance = simplify_tolerance(simplify, basemap, llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat, dpi)
+
+    read = not hasattr(shape_file, "geometry")
+    if cache_dir is None or not read:
+        shape = read_shapefile(shape_file, (llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat)) if read else shape_file
+        if region_names is None:
+            region_names = shape["RGN21NM"].unique()
+        return prepare_boundaries(shape, region_names, basemap, llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat,
+                                  clip_to_bbox, tolerance)
+
+    key = map_cache.cache_key("boundaries", [shape_file], projection="merc",
+                              llcrnrlon=llcrnrlon, llcrnrlat=llcrnrlat, urcrnrlon=urcrnrlon, urcrnrlat=urcrnrlat,
+                              clip_to_bbox=clip_to_bbox, tolerance=tolerance)
+    with map_profile.stage("cache read"):
+        boundaries = map_cache.load_arrays(cache_dir, key)
+    if boundaries is None:
+        #cache every region of the shapefile, so the entry can be reused with any metadata file
+        shape = read_shapefile(shape_file, (llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat))
+        boundaries = prepare_boundaries(shape, shape["RGN21NM"].unique(), basemap, llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat,
+                                        clip_to_bbox, tolerance)
+        map_cache.save_arrays(cache_dir, key, boundaries, max_bytes=cache_max_mb * 1e6)
+    return boundaries
+
+#keep the prepared regions named in the metadata, with their rings and vertices
+def select_boundaries(boundaries, region_names):
+    keep = np.isin(boundaries["RGN21NM"], np.asarray(region_names, dtype=str))
+    ring_keep = keep[boundaries["ring_region"]]
+    ring_lengths = np.diff(boundaries["ring_offsets"])
+    new_index = np.cumsum(keep) - 1
+
+    selected = {name: np.asarray(boundaries[name])[keep] for name in ["RGN21NM", "X", "Y"]}
+    selected["vertices"] = np.asarray(boundaries["vertices"])[np.repeat(ring_keep, ring_lengths)]
+    selected["ring_offsets"] = np.concatenate([[0], np.cumsum(ring_lengths[ring_keep])])
+    selected["ring_region"] = new_index[np.asarray(boundaries["ring_region"])[ring_keep]]
+    return selected
+
+#build one compound path (exterior and holes) per region from the projected rings
+def region_paths(vertices, ring_offsets, ring_region, n_regions):
+    from matplotlib.path import Path
+
+    codes = np.full(len(vertices), Path.LINETO, dtype=Path.code_type)
+    codes[ring_offsets[:-1]] = Path.MOVETO
+    codes[ring_offsets[1:] - 1] = Path.CLOSEPOLY
+
+    #rings of a region are contiguous, so each region is a single slice of the vertex array
+    first_ring = np.searchsorted(ring_region, np.arange(n_regions), side="left")
+    last_ring = np.searchsorted(ring_region, np.arange(n_regions), side="right")
+    starts = ring_offsets[first_ring]
+    ends = ring_offsets[last_ring]
+    return [Path(vertices[start:end], codes[start:end]) for start, end in zip(starts, ends)]
+
+#draw every region of the choropleth once, through a single collection coloured by its value
+def draw_choropleth(ax, paths, values, cmap, norm):
+    from matplotlib.collections import PathCollection
+
+    region_colours = cmap(norm(np.asarray(values, dtype=float)))
+    fills = PathCollection(paths, facecolors=region_colours, edgecolors=region_colours)
+    ax.add_collection(fills)
+    return fills
+
+#metadata file formats, chosen by file extension (compressed csv/tsv files such as .csv.gz are read as well)
+METADATA_FORMATS = ['.xlsx', '.xls', '.csv', '.tsv', '.parquet', '.feather']
+
+def metadata_format(metadata_file):
+    name = metadata_file.lower()
+    for compression in ['.gz', '.bz2', '.zip', '.xz', '.zst']:
+        if name.endswith(compression):
+            name = name[:-len(compression)]
+    extension = os.path.splitext(name)[1]
+    if extension not in METADATA_FORMATS:
+        raise ValueError(f"Invalid metadata file format: {metadata_file}. Choose from {METADATA_FORMATS}.")
+    return extension
+
+#metadata columns used by a map: the regions, the pie chart categories and the optional choropleth values
+def metadata_columns(agg_column, agg_mapinfo=None):
+    return [column for column in ["RGN21NM", agg_column, agg_mapinfo] if column is not None]
+
+#convert an excel metadata file to parquet once, next to the source file, and return the path of the parquet file
+def xlsx_to_parquet(metadata_file):
+    import pandas as pd
+
+    parquet_file = metadata_file + ".parquet"
+    if not os.path.exists(parquet_file) or os.path.getmtime(parquet_file) < os.path.getmtime(metadata_file):
+        #every column is converted, so the parquet file serves maps using any of them
+        sheet = pd.read_excel(metadata_file)
+        try:
+            try:
+                sheet.to_parquet(parquet_file + ".tmp", index=False)
+            except ImportError:
+                raise ValueError("Converting the metadata file to parquet requires the pyarrow package.")
+            except (ValueError, TypeError) as error:
+                column = unconvertible_column(sheet)
+                if column is None:
+                    raise ValueError(f"The metadata file could not be converted to parquet: {error}") from error
+                raise ValueError(f"The column '{column}' of the metadata file could not be converted to parquet, "
+                                 f"check that it does not mix numbers and text: {error}") from error
+            os.replace(parquet_file + ".tmp", parquet_file)
+        finally:
+            #no partly written file is left behind when the conversion fails
+            if os.path.exists(parquet_file + ".tmp"):
+                os.remove(parquet_file + ".tmp")
+    return parquet_file
+
+#first column of the metadata that arrow can not convert, such as a column mixing numbers and text
+def unconvertible_column(sheet):
+    import pyarrow as pa
+
+    for column in sheet.columns:
+        try:
+            pa.Array.from_pandas(sheet[column])
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return column
+    return None
+
+#read the columns needed from the metadata file, dropping the rows without a region.
+#categorical columns are read as pandas categories, so counting them works on integer codes
+def read_metadata(metadata_file, columns=None, categorical=(), xlsx_parquet=False):
+    import pandas as pd
+
+    extension = metadata_format(metadata_file)
+    if xlsx_parquet and extension in ['.xlsx', '.xls']:
+        metadata_file, extension = xlsx_to_parquet(metadata_file), '.parquet'
+
+    if extension in ['.csv', '.tsv']:
+        human_meta = pd.read_csv(metadata_file, sep='\t' if extension == '.tsv' else ',', usecols=columns,
+                                 dtype={column: "category" for column in categorical})
+    elif extension == '.parquet':
+        human_meta = pd.read_parquet(metadata_file, columns=columns)
+    elif extension == '.feather':
+        human_meta = pd.read_feather(metadata_file, columns=columns)
+    else:
+        human_meta = pd.read_excel(metadata_file, usecols=columns)
+
+    for column in categorical:
+        #sorted categories keep the order of tied pie segments the same as with text columns
+        values = human_meta[column].astype("category")
+        human_meta[column] = values.cat.set_categories(sorted(values.cat.categories))
+
+    #regions are grouped on, so they stay plain values rather than categories
+    if isinstance(human_meta["RGN21NM"].dtype, pd.CategoricalDtype):
+        human_meta["RGN21NM"] = human_meta["RGN21NM"].astype(object)
+    return human_meta.dropna(subset=["RGN21NM"])
+
+VALID_FORMATS = ['png', 'jpeg', 'svg', 'pdf']
+
+#share of the drawn regions above which MapRenderer draws a metadata delta by drawing the map again, rather than the
+#changed regions over the last frame (measured with Benchmarks/bench_incremental.py)
+INCREMENTAL_SHARE = 0.05
+
+#raise errors on the map options before any input is read or drawn
+def check_options(label_style, file_format):
+    if label_style != None and label_style != 'style1' and label_style != 'style2': 
+        raise ValueError("The label styles can only be blank, 'style1': displaying percentages of each pie segment, or 'style2': displaying total number of counts.")        
+
+    for single_format in split_formats(file_format):
+        if single_format not in VALID_FORMATS:
+            raise ValueError(f"Invalid format: {single_format}. Choose from {VALID_FORMATS}.")
+
+#raise errors on the input files and colours of the map, before any of them is read
+def check_inputs(shape_file, metadata_file, colours_dict, colormap=None):
+    for path in [shape_file, metadata_file]:
+        if not os.path.isfile(path):
+            raise ValueError(f"The input file {path} does not exist.")
+    metadata_format(metadata_file)
+    check_colours(colours_dict, colormap)
+
+def check_colours(colours_dict, colormap=None):
+    from matplotlib.colors import is_color_like
+
+    if not isinstance(colours_dict, dict) or not colours_dict:
+        raise ValueError("The colours_dict must be a dictionary of the aggregation column values and their colours.")
+    invalid = [colour for colour in colours_dict.values() if not is_color_like(colour)]
+    if invalid:
+        raise ValueError(f"Invalid colours in colours_dict: {invalid}. Use Matplotlib colour names or HEX colour codes.")
+    if colormap is not None and not isinstance(colormap, (str, list)):
+        raise ValueError("Invalid colormap format. Provide a colormap name or a list of at least two HEX colors.")
+
+#raise errors on the metadata columns used by the map
+def check_metadata(human_meta, agg_column, agg_mapinfo=None):
+    import pandas as pd
+
+    categories = human_meta[agg_column]
+    if isinstance(categories.dtype, pd.CategoricalDtype):
+        categories = categories.cat.categories
+    if not pd.api.types.is_string_dtype(categories) and not pd.api.types.is_object_dtype(categories):
+        raise ValueError("The aggregation column used for the pie charts, must be non-numeric categorical data.")
+
+    if agg_mapinfo is not None and not pd.api.types.is_numeric_dtype(human_meta[agg_mapinfo]):
+        raise ValueError("The aggregation column for Choropleth map (Map density) must be numeric data.")
+
+#raise an error on the categories of the pie charts missing from the colours dictionary
+def check_categories(human_meta, agg_column, colours_dict):
+    missing = [category for category in human_meta[agg_column].dropna().unique() if category not in colours_dict]
+    if missing:
+        raise ValueError(f"The categories {missing[:10]} of the aggregation column have no colour in colours_dict.")
+
+#attach the per region counts to the prepared boundaries of their regions
+def attach_boundaries(region_counts, boundaries):
+    import pandas as pd
+
+    boundaries = select_boundaries(boundaries, region_counts["RGN21NM"].unique())
+
+    if len(boundaries["RGN21NM"]) == 0:
+        raise ValueError("The Background map coordinates are not within the bounds of the shape file. Please adjust the coordinates.")
+
+    #attach the region anchor points to the pie chart counts
+    regions = pd.DataFrame({"RGN21NM": boundaries["RGN21NM"], "X": boundaries["X"], "Y": boundaries["Y"]})
+    region_agg2 = region_counts.merge(regions, on="RGN21NM")
+    return region_agg2, regions, boundaries
+
+#coastline resolution of the map. 'auto' picks coarser datasets for larger maps
+def pick_map_resolution(map_resolution, llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat):
+    if map_resolution != 'auto':
+        return map_resolution
+    extent = max(urcrnrlon - llcrnrlon, urcrnrlat - llcrnrlat)
+    if extent > 60:
+        return 'c'
+    if extent > 20:
+        return 'l'
+    return 'i'
+
+#store a list of line segments or polygons as one vertex array and the offsets where each of them starts
+def pack_segments(segments):
+    if len(segments) == 0:
+        return np.empty((0, 2)), np.zeros(1, dtype=int)
+    vertices = np.concatenate([np.asarray(segment, dtype=float).reshape(-1, 2) for segment in segments])
+    return vertices, np.concatenate([[0], np.cumsum([len(segment) for segment in segments])])
+
+def unpack_segments(vertices, offsets):
+    if len(offsets) < 2:
+        return []
+    return np.split(np.asarray(vertices), np.asarray(offsets)[1:-1])
+
+#projected coastlines, country borders and land/lake polygons of the map, read from the Basemap datasets
+def background_layers(llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat, resolution='i', area_thresh=0.1):
+    from matplotlib.figure import Figure
+    from mpl_toolkits.basemap import Basemap
+
+    m = Basemap(projection='merc', resolution=resolution, area_thresh=area_thresh,
+                llcrnrlon=llcrnrlon, llcrnrlat=llcrnrlat, urcrnrlon=urcrnrlon, urcrnrlat=urcrnrlat)
+
+    #country borders are only read by Basemap.drawcountries, so they are drawn on a throwaway axes to get their segments
+    country_segments = m.drawcountries(ax=Figure().add_subplot()).get_segments()
+
+    coast_vertices, coast_offsets = pack_segments(m.coastsegs)
+    country_vertices, country_offsets = pack_segments(country_segments)
+    land_vertices, land_offsets = pack_segments([np.column_stack(polygon) for polygon in m.coastpolygons])
+    return {"coast_vertices": coast_vertices, "coast_offsets": coast_offsets,
+            "country_vertices": country_vertices, "country_offsets": country_offsets,
+            "land_vertices": land_vertices, "land_offsets": land_offsets,
+            "land_types": np.asarray(m.coastpolygontypes, dtype=int)}
+
+#background layers of the map, read from the cache directory when an entry for the same map and resolution exists
+def load_background_layers(llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat, resolution='i', area_thresh=0.1,
+                           cache_dir=None, cache_max_mb=1024):
+    from mpl_toolkits.basemap import __version__ as basemap_version
 
-#start progress bar
-bar = progressbar.ProgressBar().start()
+    if cache_dir is None:
+        return background_layers(llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat, resolution, area_thresh)
+
+    key = map_cache.cache_key("background", [], projection="merc", basemap=basemap_version,
+                              llcrnrlon=llcrnrlon, llcrnrlat=llcrnrlat, urcrnrlon=urcrnrlon, urcrnrlat=urcrnrlat,
+                              resolution=resolution, area_thresh=area_thresh)
+    layers = map_cache.load_arrays(cache_dir, key)
+    if layers is None:
+        layers = background_layers(llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat, resolution, area_thresh)
+        map_cache.save_arrays(cache_dir, key, layers, max_bytes=cache_max_mb * 1e6)
+    return layers
+
+#draw line segments with the style of the Basemap drawcoastlines/drawcountries/readshapefile methods
+def draw_lines(ax, segments, linewidth, clip_path=None):
+    from matplotlib.collections import LineCollection
+
+    lines = LineCollection(segments, antialiaseds=(1,))
+    lines.set_color('k')
+    lines.set_linewidth(linewidth)
+    lines.set_label('_nolabel_')
+    ax.add_collection(lines)
+    if clip_path is not None:
+        lines.set_clip_path(clip_path)
+    return lines
+
+#fill the land polygons like Basemap.fillcontinents, lakes taking the axes background colour, in a single collection
+def fill_continents(ax, layers, color, clip_path=None):
+    from matplotlib.collections import PathCollection
+    from matplotlib.path import Path
+
+    polygons = unpack_segments(layers["land_vertices"], layers["land_offsets"])
+    lakes = np.isin(layers["land_types"], [2, 4])
+    fill_colours = [ax.get_facecolor() if lake else color for lake in lakes]
+
+    #Basemap fills the polygons from single precision vertices
+    paths = [Path(polygon.astype(np.float32), closed=True) for polygon in polygons]
+    fills = PathCollection(paths, facecolors=fill_colours, edgecolors=fill_colours, linewidths=0)
+    ax.add_collection(fills)
+    if clip_path is not None:
+        fills.set_clip_path(clip_path)
+    return fills
+
+#create the figure and draw the static background layers of a map. The region outlines of the boundaries are drawn on simple maps when given.
+#The figure is an explicit Agg figure, outside of pyplot, unless a figure is passed (eg. a pyplot figure to be shown)
+def create_background(simple_map, plainmapcol, layers, basemap, boundaries=None, fig=None):
+    if fig is None:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        fig = Figure(figsize=FIGSIZE)
+        FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    #a shared Basemap instance is copied, as Basemap keeps the map boundary patch of the figure it last drew on
+    m = copy.copy(basemap)
+
+    countries = unpack_segments(layers["country_vertices"], layers["country_offsets"])
+    if simple_map:
+        draw_lines(ax, countries, 0.5)
+        map_boundary = m.drawmapboundary(linewidth=0, ax=ax)
+        fill_continents(ax, layers, plainmapcol, clip_path=map_boundary)
+        draw_lines(ax, unpack_segments(layers["coast_vertices"], layers["coast_offsets"]), 1, clip_path=map_boundary)
+
+        #creating boundaries on simple map
+        if boundaries is not None:
+            draw_lines(ax, unpack_segments(boundaries["vertices"], boundaries["ring_offsets"]), 0.5, clip_path=map_boundary)
+
+    #background for complex map with background information (Chloropleth)
+    else:
+        draw_lines(ax, countries, 0.5)
+        m.drawmapboundary(ax=ax)
+
+    ax.axis("off")
+    return {"fig": fig, "ax": ax, "basemap": m, "colorbar": None}
+
+#colour map of the choropleth, from a colormap name or a list of colours
+def choropleth_colormap(colormap):
+    import matplotlib.cm as cm
+    from matplotlib.colors import LinearSegmentedColormap
+
+    # Determine if the colormap is a custom list or a predefined palette
+    if isinstance(colormap, str):
+        return cm.get_cmap(colormap, 100)
+    elif isinstance(colormap, list):
+        return LinearSegmentedColormap.from_list('custom_colormap', colormap, N=100)
+    else:
+        raise ValueError("Invalid colormap format. Provide a colormap name or a list of at least two HEX colors.")
+
+#draw the layers that change from map to map on a background: choropleth fill, pie charts, labels, legend and colour bar.
+#Returns the pie and choropleth collections and the (region, text) pairs of the pie labels
+def draw_overlays(background, region_agg2, regions, boundaries, agg_column, colours_dict,
+                  region_values=None, value_range=None, pie_size=100, legend_title='Legend', colorbar_title='ColourBar',
+                  colormap='BuPu', label_style=None, pie_fontsize=15, pie_rotation=0,
+                  legend_fontsize=20, colorbar_fontsize=20, legend_bbox_to_anchor=[0.005,0.6,0,0], pie_text_loc=0.17):
+    import matplotlib.cm as cm
+    import matplotlib.lines as mlines
+    from matplotlib.colors import Normalize
+
+    fig, ax, m = background["fig"], background["ax"], background["basemap"]
+    fills = None
+
+    #code for complex map with background information (Chloropleth)
+    if value_range is not None:
+        cmap = choropleth_colormap(colormap)
+
+        # Normalize values for the colormap
+        norm = Normalize(vmin=value_range[0], vmax=value_range[1])
+
+        #fill the projected region outlines (MultiPolygon, Polygon and their holes) as a single collection
+        with map_profile.stage("choropleth fill"):
+            paths = region_paths(boundaries["vertices"], boundaries["ring_offsets"], boundaries["ring_region"], len(regions))
+            fills = draw_choropleth(ax, paths, regions["RGN21NM"].map(region_values), cmap, norm)
+
+    with map_profile.stage("pie drawing"):
+        pies, labels = draw_pies(region_agg2, agg_column, colours_dict, pie_size, m, ax, label_style=label_style, pie_fontsize=pie_fontsize, pie_rotation=pie_rotation, pie_text_loc=pie_text_loc)
+
+        #setting markers for style2 of pie charts
+        if label_style == 'style2':
+            labels = draw_totals(ax, total_label_specs(region_agg2, m), value_range is None, pie_fontsize)
+
+    if value_range is not None:
+        #setting parameters for colour bar of map, reusing the colour bar of the background when it already has one
+        sm = cm.ScalarMappable(cmap=cmap, norm=norm)
+        sm.set_array([])
+        if background["colorbar"] is None:
+            background["colorbar"] = fig.colorbar(sm, ax=ax, orientation='vertical', shrink=0.4)
+        else:
+            background["colorbar"].update_normal(sm)
+        background["colorbar"].set_label(colorbar_title, labelpad=-65, fontsize=colorbar_fontsize)
+
+    #setting legend for pies
+    legend_handles = [mlines.Line2D([], [], color=color, marker='o', linestyle='None', 
+                                    markersize=10, label=label) 
+                      for label, color in colours_dict.items()]
+    ax.legend(handles=legend_handles, title=legend_title, title_fontsize=legend_fontsize + 5, 
+              fontsize=legend_fontsize, bbox_to_anchor=legend_bbox_to_anchor)
+    return {"pies": pies, "fills": fills, "labels": labels}
+
+#number of regions and vertices of the map, for the --profile report
+def count_geometry(regions, boundaries, layers):
+    map_profile.count("regions", len(regions))
+    map_profile.count("region_vertices", len(boundaries["vertices"]))
+    map_profile.count("background_vertices", sum(len(layers[name]) for name in ["coast_vertices", "country_vertices", "land_vertices"]))
+
+#save output, once per file format of a comma separated list
+def save_map(fig, output_file_prefix='Output_map', file_format="png", dpi=300):
+    if map_profile.enabled():
+        map_profile.count_figure(fig)
+    for single_format in split_formats(file_format):
+        with map_profile.stage("savefig"):
+            fig.savefig(f"{output_file_prefix}.{single_format}", format=single_format, dpi=dpi)
+
+#draw the items of a collection selected by a boolean mask, through a shallow copy of the collection
+def draw_subset(collection, selected, renderer):
+    if not selected.any():
+        return
+    index = np.flatnonzero(selected)
+    #matplotlib (3.5 to 3.10) draws a collection of a single path, colour and size with draw_markers, which places it on
+    #whole pixels, where the full collection goes through draw_path_collection. A lone selected item is drawn along with an
+    #unselected one, which lies outside the dirty areas copied into the frame, so that it takes the same drawing path.
+    #bench_incremental.py checks the frames against full redraws
+    if len(index) == 1 and len(selected) > 1:
+        index = np.sort(np.append(index, np.flatnonzero(~selected)[0]))
+    paths = collection.get_paths()
+    subset = copy.copy(collection)
+    subset.set_paths([paths[i] for i in index])
+
+    #properties given per item are selected as well, shared ones are kept
+    for getter, setter in [("get_offsets", "set_offsets"), ("get_sizes", "set_sizes"), ("get_facecolor", "set_facecolor"),
+                           ("get_edgecolor", "set_edgecolor"), ("get_linewidth", "set_linewidth")]:
+        values = getattr(collection, getter)()
+        if values is not None and not isinstance(values, str) and len(values) == len(selected) > 1:
+            getattr(subset, setter)(np.asarray(values)[index])
+    subset.draw(renderer)
+
+#long-lived map, built once from a shapefile (or GeoDataFrame) and a metadata DataFrame (or file). The boundaries, background
+#layers and figure are prepared once, the counts can be replaced with update_counts and the map rendered to bytes, a buffer
+#or files any number of times. The figure is an explicit Agg figure unless fig is given (eg. a pyplot figure to be shown)
+class MapRenderer:
+    def __init__(self, shape, metadata, agg_column, colours_dict,
+                 agg_mapinfo=None, plainmapcol="lightsteelblue",
+                 pie_size=100,
+                 simple_map_boundaries=False, legend_title='Legend', colorbar_title='ColourBar',
+                 colormap='BuPu', label_style=None, pie_fontsize=15, pie_rotation=0,
+                 legend_fontsize=20, colorbar_fontsize=20,
+                 llcrnrlon=-6, llcrnrlat=49.9, urcrnrlon=2, urcrnrlat=55.9,
+                 dpi=300, legend_bbox_to_anchor=[0.005,0.6,0,0], pie_text_loc=0.17,
+                 cache_dir=None, cache_max_mb=1024, clip_to_bbox=False, simplify=None, map_resolution='i',
+                 all_regions=True, fig=None):
+        check_options(label_style, "png")
+        check_colours(colours_dict, colormap)
+
+        self.agg_column = agg_column
+        self.agg_mapinfo = agg_mapinfo
+        self.colours_dict = colours_dict
+        self.dpi = dpi
+        self.overlay_options = {"pie_size": pie_size, "legend_title": legend_title, "colorbar_title": colorbar_title,
+                                "colormap": colormap, "label_style": label_style, "pie_fontsize": pie_fontsize,
+                                "pie_rotation": pie_rotation, "legend_fontsize": legend_fontsize,
+                                "colorbar_fontsize": colorbar_fontsize, "legend_bbox_to_anchor": legend_bbox_to_anchor,
+                                "pie_text_loc": pie_text_loc}
+
+        #the metadata is checked before any geometry is read
+        if isinstance(metadata, str):
+            with map_profile.stage("metadata read"):
+                metadata = read_metadata(metadata, metadata_columns(agg_column, agg_mapinfo), [agg_column])
+        metadata = metadata.dropna(subset=["RGN21NM"])
+        check_metadata(metadata, agg_column, agg_mapinfo)
+
+        #every region of the shapefile is prepared, so later counts can add regions, unless all_regions is False.
+        #The outlines of every region are drawn on simple maps with boundaries, so all of them are prepared in that case
+        simple_map = agg_mapinfo is None
+        outlines = simple_map and simple_map_boundaries
+        region_names = None if all_regions or outlines else metadata["RGN21NM"].unique()
+        self.boundaries = load_boundaries(shape, region_names, llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat,
+                                          cache_dir=cache_dir, cache_max_mb=cache_max_mb,
+                                          clip_to_bbox=clip_to_bbox, simplify=simplify, dpi=dpi)
+
+        #coastlines, country borders and land polygons, drawn on a Basemap instance without the datasets
+        resolution = pick_map_resolution(map_resolution, llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat)
+        with map_profile.stage("background"):
+            self.layers = load_background_layers(llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat, resolution,
+                                                 cache_dir=cache_dir, cache_max_mb=cache_max_mb)
+            self.background = create_background(simple_map, plainmapcol, self.layers,
+                                                map_projection(llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat),
+                                                self.boundaries if outlines else None, fig)
+        self.static_artists = set(self.background["ax"].get_children())
+        self.overlays = {}
+        self.frame = None
+
+        self.update_counts(metadata)
+
+    @property
+    def figure(self):
+        return self.background["fig"]
+
+    #replace the metadata of the map. The pie charts and choropleth are redrawn on the next render
+    def update_counts(self, metadata):
+        metadata = metadata.dropna(subset=["RGN21NM"])
+        check_metadata(metadata, self.agg_column, self.agg_mapinfo)
+        check_categories(metadata, self.agg_column, self.colours_dict)
+
+        with map_profile.stage("merge"):
+            self.region_counts, self.region_values = aggregate_metadata(metadata, self.agg_column, self.agg_mapinfo)
+            self.region_agg2, self.regions, self.region_boundaries = attach_boundaries(self.region_counts, self.boundaries)
+        self._metadata = metadata
+        #the rows of each region, split on the first delta
+        self.region_rows = None
+        self.value_range = self.metadata_range(metadata)
+        self.drawn = False
+
+    #metadata of the map. Once deltas were applied it is put together from the rows of each region, grouped by region
+    @property
+    def metadata(self):
+        import pandas as pd
+
+        if self._metadata is None:
+            self._metadata = pd.concat(list(self.region_rows.values())) if self.region_rows else self.empty_rows
+        return self._metadata
+
+    #range of the choropleth values of the metadata
+    def metadata_range(self, metadata):
+        if self.agg_mapinfo is None:
+            return None
+        return (metadata[self.agg_mapinfo].min(), metadata[self.agg_mapinfo].max())
+
+    #split the metadata into the rows of each region, with the region of each row label and the range of the choropleth
+    #values of each region, so that a delta only reads and copies the rows of the regions it changes
+    def split_metadata(self):
+        metadata = self._metadata
+        if not metadata.index.is_unique:
+            raise ValueError("Metadata deltas need the index labels of the metadata of the map to be unique.")
+        self.empty_rows = metadata.iloc[:0]
+        self.region_rows = {region: rows for region, rows in metadata.groupby("RGN21NM", sort=False, observed=True)}
+        self.row_region = {}
+        for region, rows in self.region_rows.items():
+            self.row_region.update(dict.fromkeys(rows.index, region))
+        self.region_ranges = {region: self.metadata_range(rows) for region, rows in self.region_rows.items()}
+
+    #range of the choropleth values of the metadata, from the ranges of its regions
+    def regions_range(self):
+        import pandas as pd
+
+        if self.agg_mapinfo is None:
+            return None
+        if not self.region_ranges:
+            return self.metadata_range(self.empty_rows)
+        lows, highs = zip(*self.region_ranges.values())
+        return (pd.Series(lows).min(), pd.Series(highs).max())
+
+    #add metadata rows (a DataFrame) and remove others (a DataFrame or the index labels of the rows) without recounting the
+    #whole metadata. Only the regions of these rows are counted again, and once the map is drawn only their pie charts,
+    #labels and choropleth fills are updated, and redrawn over the last frame on the next PNG render. The map is redrawn
+    #in full when the range of the choropleth values changes, as every fill and the colour bar change with it.
+    #The metadata is split by region on the first delta, after which a delta costs the rows of the regions it changes.
+    #A delta is checked before anything changes, and if applying it fails the map is left as it was before the delta.
+    #Returns the names of the regions whose rows changed
+    def apply_delta(self, added=None, removed=None):
+        import pandas as pd
+
+        if self.region_rows is None:
+            self.split_metadata()
+        removed_labels = {}
+        if removed is not None:
+            labels = removed.index if isinstance(removed, pd.DataFrame) else pd.Index(removed)
+            missing = [label for label in labels if label not in self.row_region]
+            if missing:
+                raise ValueError(f"The rows to remove are not in the metadata of the map: {missing[:10]}.")
+            for label in labels.unique():
+                removed_labels.setdefault(self.row_region[label], []).append(label)
+        if added is not None and len(added) > 0:
+            added = added.dropna(subset=["RGN21NM"])
+            check_metadata(added, self.agg_column, self.agg_mapinfo)
+            check_categories(added, self.agg_column, self.colours_dict)
+            #rows are removed by index label, so the labels of the added rows have to be new
+            freed = {label for region_labels in removed_labels.values() for label in region_labels}
+            reused = [label for label in added.index if label in self.row_region and label not in freed]
+            if reused:
+                raise ValueError(f"The added rows reuse index labels of the metadata of the map: {reused[:10]}.")
+        else:
+            added = None
+
+        #the state a delta changes, kept to be put back if it fails
+        regions = set(removed_labels) | (set(added["RGN21NM"]) if added is not None else set())
+        saved_regions = {region: (self.region_rows.get(region), self.region_ranges.get(region)) for region in regions}
+        saved = {name: getattr(self, name) for name in ["_metadata", "region_counts", "region_values", "region_agg2",
+                                                         "regions", "region_boundaries", "value_range"]}
+        try:
+            return self.change_rows(removed_labels, added)
+        except BaseException:
+            for region, (rows, value_range) in saved_regions.items():
+                if rows is None:
+                    self.region_rows.pop(region, None)
+                    self.region_ranges.pop(region, None)
+                else:
+                    self.region_rows[region] = rows
+                    self.region_ranges[region] = value_range
+            if added is not None:
+                for label in added.index:
+                    self.row_region.pop(label, None)
+            for region, region_labels in removed_labels.items():
+                self.row_region.update(dict.fromkeys(region_labels, region))
+            for name, value in saved.items():
+                setattr(self, name, value)
+            #the overlays may be partly updated, so the whole map is drawn again on the next render
+            self.drawn = False
+            raise
+
+    #remove and add the rows of a checked delta, count their regions again and update the drawn overlays
+    def change_rows(self, removed_labels, added):
+        import pandas as pd
+
+        changed = set(removed_labels)
+        gained_rows = None
+        for region, region_labels in removed_labels.items():
+            self.region_rows[region] = self.region_rows[region].drop(region_labels)
+            for label in region_labels:
+                del self.row_region[label]
+        if added is not None:
+            #the rows of the regions gaining rows are put together and split by region once, the added rows after the others
+            gaining = [self.region_rows[region] for region in added["RGN21NM"].unique() if region in self.region_rows]
+            gained_rows = pd.concat(gaining + [added])
+            for region, rows in gained_rows.groupby("RGN21NM", sort=False, observed=True):
+                self.region_rows[region] = rows
+            self.row_region.update(zip(added.index, added["RGN21NM"]))
+            changed.update(added["RGN21NM"])
+        for region in changed:
+            if len(self.region_rows[region]) == 0:
+                del self.region_rows[region]
+                del self.region_ranges[region]
+            else:
+                self.region_ranges[region] = self.metadata_range(self.region_rows[region])
+        self._metadata = None
+        if not changed:
+            return changed
+
+        with map_profile.stage("merge"):
+            #the counts of a region only depend on its own rows, in the same order as in the whole metadata. The rows of
+            #the regions gaining rows are already put together
+            changed_rows = [gained_rows] if gained_rows is not None else []
+            gaining = set(added["RGN21NM"]) if added is not None else set()
+            changed_rows += [self.region_rows[region] for region in changed - gaining if region in self.region_rows]
+            changed_rows = pd.concat(changed_rows) if len(changed_rows) > 1 else (changed_rows[0] if changed_rows else self.empty_rows)
+            counts, values = aggregate_metadata(changed_rows, self.agg_column, self.agg_mapinfo)
+            present = set(self.region_counts["RGN21NM"]) & changed
+            kept = self.region_counts[~self.region_counts["RGN21NM"].isin(changed)]
+            #regions left without rows add no counts, and would turn the count columns to floats
+            parts = [kept, counts] if len(counts) > 0 else [kept]
+            self.region_counts = pd.concat(parts).sort_values("RGN21NM", kind="stable").reset_index(drop=True)
+            if values is not None:
+                self.region_values = pd.concat([self.region_values[~self.region_values.index.isin(changed)], values])
+
+            #the boundaries are only selected again when regions appear or disappear
+            regions_changed = present != set(counts["RGN21NM"])
+            if regions_changed:
+                self.region_agg2, self.regions, self.region_boundaries = attach_boundaries(self.region_counts, self.boundaries)
+            else:
+                self.region_agg2 = self.region_counts.merge(self.regions, on="RGN21NM")
+
+        value_range = self.regions_range()
+        if value_range != self.value_range or self.region_agg2.empty or self.overlays.get("pies") is None:
+            self.value_range = value_range
+            self.drawn = False
+        elif self.drawn:
+            #past a share of the regions, updating the overlays and drawing the changed regions over the last frame is
+            #slower than drawing the overlays and the map again, counting the regions changed since the last frame too
+            pending = changed | (self.frame["changed"] if self.frame is not None and self.frame["image"] is not None else set())
+            if len(pending) > INCREMENTAL_SHARE * len(self.regions):
+                self.drawn = False
+            else:
+                self.update_overlays(changed, regions_changed)
+        return changed
+
+    #update the pie charts, labels and choropleth fills of the changed regions in the drawn overlays, noting the
+    #areas of the last frame they cover before and after the update
+    def update_overlays(self, changed, regions_changed):
+        m = self.background["basemap"]
+        options = self.overlay_options
+        frame = self.frame
+        if frame is not None and frame["image"] is not None:
+            frame["dirty"].extend(self.region_extents(changed))
+            frame["changed"].update(changed)
+
+        with map_profile.stage("pie drawing"):
+            segments = pie_segments(self.region_agg2, self.agg_column, self.colours_dict, options["pie_size"], m, options["pie_text_loc"])
+            pies = self.overlays["pies"]
+            pies.set_offsets(np.column_stack([segments["x"], segments["y"]]))
+            pies.set_sizes(segments["size"])
+            pies.set_paths(segments["path"])
+            pies.set_facecolor(list(segments["colour"]))
+            self.overlays["pie_regions"] = segments["region"]
+
+            if options["label_style"] is not None:
+                self.relabel(segments)
+
+        fills = self.overlays["fills"]
+        if fills is not None:
+            from matplotlib.colors import Normalize
+
+            with map_profile.stage("choropleth fill"):
+                if regions_changed:
+                    boundaries = self.region_boundaries
+                    fills.set_paths(region_paths(boundaries["vertices"], boundaries["ring_offsets"], boundaries["ring_region"], len(self.regions)))
+                    self.overlays["fill_regions"] = self.regions["RGN21NM"].to_numpy()
+                    if frame is not None:
+                        frame["fill_extents"] = None
+                values = np.asarray(self.regions["RGN21NM"].map(self.region_values), dtype=float)
+                region_colours = choropleth_colormap(options["colormap"])(Normalize(*self.value_range)(values))
+                fills.set_facecolor(region_colours)
+                fills.set_edgecolor(region_colours)
+
+        if frame is not None and frame["image"] is not None:
+            frame["dirty"].extend(self.region_extents(changed))
+
+    #give the labels of the pie charts their new texts and positions. The texts already drawn are reused in order, so that
+    #overlapping labels are drawn in the same order as on a new map, and labels are only added or removed at the end
+    def relabel(self, segments):
+        ax, m = self.background["ax"], self.background["basemap"]
+        options = self.overlay_options
+        if options["label_style"] == 'style1':
+            specs = pie_label_specs(segments)
+        else:
+            specs = total_label_specs(self.region_agg2, m)
+
+        old = self.overlays["labels"]
+        labels = []
+        for (region, x, y, label), (_, text) in zip(specs, old):
+            text.set_text(label)
+            text.set_position((x, y))
+            if hasattr(text, "xy"):
+                text.xy = (x, y)
+            labels.append((region, text))
+        for _, text in old[len(specs):]:
+            text.remove()
+        if options["label_style"] == 'style1':
+            labels += draw_pie_labels(ax, specs[len(old):], options["pie_fontsize"], options["pie_rotation"])
+        else:
+            labels += draw_totals(ax, specs[len(old):], self.agg_mapinfo is None, options["pie_fontsize"])
+        self.overlays["labels"] = labels
+
+    #display extents of the pie charts, labels and choropleth fills of the given regions, padded for their edges,
+    #label outlines and antialiasing
+    def region_extents(self, regions):
+        ax = self.background["ax"]
+        renderer = self.figure.canvas.get_renderer()
+        points = self.figure.dpi / 72
+        extents = []
+
+        pies = self.overlays["pies"]
+        selected = np.isin(self.overlays["pie_regions"], list(regions))
+        if selected.any():
+            centres = ax.transData.transform(pies.get_offsets()[selected])
+            radius = 0.5 * np.sqrt(pies.get_sizes()[selected]) * points + np.max(pies.get_linewidth()) * points + 2
+            extents.extend(np.column_stack([centres - radius[:, None], centres + radius[:, None]]))
+
+        for region, text in self.overlays["labels"]:
+            if region in regions:
+                extents.append(self.text_extent(text, renderer))
+
+        if self.overlays["fills"] is not None:
+            fill_extents = self.fill_extents()
+            extents.extend(fill_extents[np.isin(self.overlays["fill_regions"], list(regions))])
+        return extents
+
+    #display extent of a text, with its 5 points wide outline. The labels of a map share their style, so the extents
+    #are kept by position and text
+    def text_extent(self, text, renderer):
+        cache = self.frame["text_extents"]
+        key = (type(text), text.get_position(), text.get_text())
+        if key not in cache:
+            pad = 2.5 * self.figure.dpi / 72 + 2
+            x0, y0, x1, y1 = text.get_window_extent(renderer).extents
+            cache[key] = (x0 - pad, y0 - pad, x1 + pad, y1 + pad)
+        return cache[key]
+
+    #display extents of the choropleth fill of each region
+    def fill_extents(self):
+        if self.frame["fill_extents"] is None:
+            ax = self.background["ax"]
+            fills = self.overlays["fills"]
+            pad = np.max(fills.get_linewidth()) * self.figure.dpi / 72 + 2
+            extents = np.array([path.get_extents(ax.transData).extents for path in fills.get_paths()]).reshape(-1, 4)
+            self.frame["fill_extents"] = extents + [-pad, -pad, pad, pad]
+        return self.frame["fill_extents"]
+
+    #draw the pie charts, choropleth, legend and colour bar of the current counts over the background
+    def draw(self):
+        if self.drawn:
+            return
+        ax = self.background["ax"]
+        for artist in ax.get_children():
+            if artist not in self.static_artists:
+                artist.remove()
+
+        count_geometry(self.regions, self.region_boundaries, self.layers)
+        self.overlays = draw_overlays(self.background, self.region_agg2, self.regions, self.region_boundaries, self.agg_column, self.colours_dict,
+                                      self.region_values, self.value_range, **self.overlay_options)
+        self.overlays["pie_regions"] = np.sort(self.region_agg2["RGN21NM"].to_numpy(), kind="stable")
+        self.overlays["fill_regions"] = self.regions["RGN21NM"].to_numpy()
+        self.drawn = True
+        if self.frame is not None:
+            self.frame["image"] = None
+
+    #artists drawn over the first pie chart or choropleth fill, in drawing order: the overlays, the background lines
+    #above them, and the figure artists drawn after the map axes (the colour bar)
+    def overlay_order(self):
+        fig, ax = self.figure, self.background["ax"]
+        artists = ax.get_children()
+        artists.remove(ax.patch)
+        if not (ax.axison and ax.get_frame_on()):
+            artists = [artist for artist in artists if artist not in ax.spines.values()]
+        if not ax.axison:
+            artists = [artist for artist in artists if artist not in [ax.xaxis, ax.yaxis]]
+        artists = sorted(artists, key=lambda artist: artist.get_zorder())
+        first = min(i for i, artist in enumerate(artists) if artist not in self.static_artists)
+
+        figure_artists = sorted([artist for artist in fig.get_children() if artist is not fig.patch], key=lambda artist: artist.get_zorder())
+        return artists[first:] + figure_artists[figure_artists.index(ax) + 1:]
+
+    #draw the map at dpi and return its RGBA pixels, which are kept to be updated by the next call. The pixels under the
+    #overlays are kept as well, so that after apply_delta only the areas of the changed regions are drawn again
+    def draw_frame(self, dpi=None):
+        fig, ax = self.figure, self.background["ax"]
+        dpi = self.dpi if dpi is None else dpi
+        if fig.dpi != dpi:
+            fig.dpi = dpi
+            self.frame = None
+        self.draw()
+
+        canvas = fig.canvas
+        position = tuple(ax.get_position(original=True).bounds)
+        frame = self.frame
+        if frame is not None and frame["image"] is not None and frame["position"] == position:
+            #apply_delta only leaves dirty areas while few regions changed, else the map is drawn again in full
+            if frame["dirty"]:
+                with map_profile.stage("incremental draw"):
+                    self.draw_dirty(frame)
+            return frame["image"]
+
+        with map_profile.stage("draw"):
+            if frame is None or frame["position"] != position:
+                #the background drawn without the overlays, restored under the changed areas
+                hidden = [artist for artist in self.overlay_order() if artist.get_visible()]
+                for artist in hidden:
+                    artist.set_visible(False)
+                try:
+                    canvas.draw()
+                    frame = {"position": position, "under": np.array(canvas.buffer_rgba())}
+                finally:
+                    for artist in hidden:
+                        artist.set_visible(True)
+            canvas.draw()
+            frame.update({"image": np.array(canvas.buffer_rgba()), "dirty": [], "changed": set(), "text_extents": {}, "fill_extents": None,
+                          "legend_extent": self.legend_extent(canvas.get_renderer())})
+        self.frame = frame
+        return frame["image"]
+
+    #display extent of the legend, or None when the map has none
+    def legend_extent(self, renderer):
+        legend = self.background["ax"].get_legend()
+        if legend is None:
+            return None
+        x0, y0, x1, y1 = legend.get_window_extent(renderer).extents
+        return (x0 - 2, y0 - 2, x1 + 2, y1 + 2)
+
+    #redraw the dirty areas of the last frame: the background under them is restored, the overlays crossing them are
+    #drawn again in order (only the pie segments and fills within them), and the areas are copied into the frame
+    def draw_dirty(self, frame):
+        from matplotlib.text import Text
+
+        renderer = self.figure.canvas.get_renderer()
+        pixels = np.asarray(renderer.buffer_rgba())
+        pixels[...] = frame["under"]
+        height, width = pixels.shape[:2]
+
+        #the legend is placed where it covers the fewest pie charts and labels, so it can move with them
+        legend_extent = self.legend_extent(renderer)
+        if legend_extent != frame["legend_extent"]:
+            frame["dirty"].extend([extent for extent in [frame["legend_extent"], legend_extent] if extent is not None])
+            frame["legend_extent"] = legend_extent
+        dirty = np.array(frame["dirty"], dtype=float).reshape(-1, 4)
+
+        def crossing(extents):
+            extents = np.asarray(extents, dtype=float).reshape(-1, 1, 4)
+            overlap = ((extents[..., 0] < dirty[:, 2]) & (extents[..., 2] > dirty[:, 0]) &
+                       (extents[..., 1] < dirty[:, 3]) & (extents[..., 3] > dirty[:, 1]))
+            return overlap.any(axis=1)
+
+        pies, fills = self.overlays["pies"], self.overlays["fills"]
+        legend = self.background["ax"].get_legend()
+        order = self.overlay_order()
+        texts = [artist for artist in order if isinstance(artist, Text)]
+        redraw_texts = set(np.array(texts, dtype=object)[crossing([self.text_extent(text, renderer) for text in texts])]) if texts else set()
+        for artist in order:
+            if artist is pies:
+                centres = self.background["ax"].transData.transform(pies.get_offsets())
+                points = self.figure.dpi / 72
+                radius = 0.5 * np.sqrt(pies.get_sizes()) * points + np.max(pies.get_linewidth()) * points + 2
+                draw_subset(pies, crossing(np.column_stack([centres - radius[:, None], centres + radius[:, None]])), renderer)
+            elif artist is fills:
+                draw_subset(fills, crossing(self.fill_extents()), renderer)
+            elif isinstance(artist, Text):
+                if artist in redraw_texts:
+                    artist.draw(renderer)
+            elif artist is legend:
+                if crossing(legend_extent)[0]:
+                    artist.draw(renderer)
+            else:
+                artist.draw(renderer)
+
+        image = frame["image"]
+        for x0, y0, x1, y1 in dirty:
+            columns = slice(max(int(np.floor(x0)), 0), min(int(np.ceil(x1)), width))
+            rows = slice(max(height - int(np.ceil(y1)), 0), min(height - int(np.floor(y0)), height))
+            image[rows, columns] = pixels[rows, columns]
+        frame["dirty"] = []
+        frame["changed"] = set()
+
+    #write the map to a file name or an open binary buffer, in one file format. PNG images are encoded from draw_frame,
+    #so that after apply_delta only the changed regions are drawn again
+    def render_to(self, buffer, file_format="png", dpi=None):
+        check_options(None, file_format)
+        dpi = self.dpi if dpi is None else dpi
+        if file_format == "png":
+            from matplotlib.image import imsave
+
+            image = self.draw_frame(dpi)
+            if map_profile.enabled():
+                map_profile.count_figure(self.figure)
+            with map_profile.stage("savefig"):
+                imsave(buffer, image, format="png", origin="upper", dpi=dpi)
+            return
+
+        self.draw()
+        if map_profile.enabled():
+            map_profile.count_figure(self.figure)
+        with map_profile.stage("savefig"):
+            self.figure.savefig(buffer, format=file_format, dpi=dpi)
+
+    #the map as the bytes of an image file
+    def render(self, file_format="png", dpi=None):
+        buffer = io.BytesIO()
+        self.render_to(buffer, file_format, dpi)
+        return buffer.getvalue()
+
+    #save the map as <output_file_prefix>.<format>, once per file format of a comma separated list
+    def save(self, output_file_prefix='Output_map', file_format="png"):
+        check_options(None, file_format)
+        self.draw()
+        save_map(self.figure, output_file_prefix, file_format, self.dpi)
+
+    #release the figure. Explicit figures are left to the garbage collector, pyplot figures are closed
+    def close(self):
+        if self.background is not None and self.figure.canvas.manager is not None:
+            import matplotlib.pyplot as plt
+
+            plt.close(self.figure)
+        self.background = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 def create_map_with_pie_charts(shape_file, metadata_file, agg_column, colours_dict,
                                agg_mapinfo=None, plainmapcol="lightsteelblue", 
@@ -153,177 +1445,178 @@ def create_map_with_pie_charts(shape_file, metadata_file, agg_column, colours_di
                                legend_fontsize=20, colorbar_fontsize=20,
                                llcrnrlon=-6, llcrnrlat=49.9, urcrnrlon=2, urcrnrlat=55.9, 
                                output_file_prefix='Output_map',file_format="png", dpi=300, legend_bbox_to_anchor=[0.005,0.6,0,0],
-                               pie_text_loc=0.17):
+                               pie_text_loc=0.17, cache_dir=None, cache_max_mb=1024, xlsx_parquet=False,
+                               clip_to_bbox=False, simplify=None, map_resolution='i'):
+    import matplotlib.pyplot as plt
 
+    #raising Errors
+    check_options(label_style, file_format)
+    check_inputs(shape_file, metadata_file, colours_dict, colormap)
 
     #set two input files. Shapefile and metadatafile
-    shape = gpd.read_file(shape_file)
-    human_meta = pd.read_excel(metadata_file)
+    with map_profile.stage("metadata read"):
+        human_meta = read_metadata(metadata_file, metadata_columns(agg_column, agg_mapinfo), [agg_column], xlsx_parquet)
 
-    #merge two input files
-    shape = shape.merge(human_meta, how="right", on="RGN21NM")
-    shape = shape.dropna(subset=["RGN21NM"])
-    
-    #setting format of shapefile for simple map to read region directories
-    shape_dir = os.path.dirname(shape_file)
-    base_name = os.path.splitext(os.path.basename(shape_file))[0]
+    #the map is drawn on a pyplot figure so that it can be shown once saved. Only the regions of the metadata are prepared
+    renderer = MapRenderer(shape_file, human_meta, agg_column, colours_dict,
+                           agg_mapinfo, plainmapcol, pie_size, simple_map_boundaries, legend_title, colorbar_title,
+                           colormap, label_style, pie_fontsize, pie_rotation, legend_fontsize, colorbar_fontsize,
+                           llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat, dpi, legend_bbox_to_anchor, pie_text_loc,
+                           cache_dir, cache_max_mb, clip_to_bbox, simplify, map_resolution,
+                           all_regions=False, fig=plt.figure(figsize=FIGSIZE))
+    renderer.save(output_file_prefix, file_format)
+    plt.show()
 
-    #reformating projection of shape file (requires fiona library)
-    shape = shape.to_crs(epsg=4326)
+#empty store for the inputs, Basemap instances and backgrounds shared by the jobs of a batch
+def new_batch_state(jobs=()):
+    #each metadata file is read once, with the columns used by all the jobs reading it
+    columns, categorical, numeric = {}, {}, {}
+    for job in jobs:
+        columns.setdefault(job.metadata_file, set()).update(metadata_columns(job.agg_column, job.agg_mapinfo))
+        categorical.setdefault(job.metadata_file, set()).add(job.agg_column)
+        numeric.setdefault(job.metadata_file, set()).add(job.agg_mapinfo)
+    for metadata_file in categorical:
+        categorical[metadata_file] -= numeric[metadata_file]
+    return {"metadata": {}, "boundaries": {}, "basemaps": {}, "layers": {}, "backgrounds": {},
+            "columns": columns, "categorical": categorical}
 
-    fig, ax = plt.subplots(figsize=(20, 18))
+#inputs of a job, loaded the first time a metadata file, shapefile or bounding box is used in the batch
+def load_job_inputs(job, state):
+    if job.metadata_file not in state["metadata"]:
+        columns = state["columns"].get(job.metadata_file, metadata_columns(job.agg_column, job.agg_mapinfo))
+        categorical = state["categorical"].get(job.metadata_file, [job.agg_column])
+        with map_profile.stage("metadata read"):
+            state["metadata"][job.metadata_file] = read_metadata(job.metadata_file, sorted(columns), sorted(categorical), job.xlsx_to_parquet)
 
-    #creating bounding box coordinates to ensure shape file coordinates are contained within the box.
-    bounding_box = Polygon([(llcrnrlon, llcrnrlat), (urcrnrlon, llcrnrlat), (urcrnrlon, urcrnrlat), (llcrnrlon, urcrnrlat)])
-    shapes_in_bbox = shape[shape.geometry.apply(lambda geom:
-        (isinstance(geom, Polygon) and geom.intersects(bounding_box)) or
-        (isinstance(geom, MultiPolygon) and any(poly.intersects(bounding_box) for poly in geom.geoms))
-    )]
+    #all the regions of the shapefile are prepared, so every job using it can select its own
+    corners = (job.llcrnrlon, job.llcrnrlat, job.urcrnrlon, job.urcrnrlat)
+    boundaries_key = (job.shape_file, corners, job.clip_to_bbox, job.simplify, job.simplify and job.dpi)
+    if boundaries_key not in state["boundaries"]:
+        state["boundaries"][boundaries_key] = load_boundaries(job.shape_file, None, *corners,
+                                                              cache_dir=None if job.no_cache else job.cache_dir,
+                                                              cache_max_mb=job.cache_max_mb,
+                                                              clip_to_bbox=job.clip_to_bbox, simplify=job.simplify, dpi=job.dpi)
 
-    #raising Errors
-    if shapes_in_bbox.empty:
-        raise ValueError("The Background map coordinates are not within the bounds of the shape file. Please adjust the coordinates.")
-            
-    if not pd.api.types.is_string_dtype(shape[agg_column]) and not pd.api.types.is_object_dtype(shape[agg_column]):
-        raise ValueError("The aggregation column used for the pie charts, must be non-numeric categorical data.")
+    if corners not in state["basemaps"]:
+        state["basemaps"][corners] = map_projection(*corners)
 
-    if label_style != None and label_style != 'style1' and label_style != 'style2': 
-        raise ValueError("The label styles can only be blank, 'style1': displaying percentages of each pie segment, or 'style2': displaying total number of counts.")        
+    layers_key = (corners, pick_map_resolution(job.map_resolution, *corners))
+    if layers_key not in state["layers"]:
+        with map_profile.stage("background"):
+            state["layers"][layers_key] = load_background_layers(*layers_key[0], layers_key[1],
+                                                                 cache_dir=None if job.no_cache else job.cache_dir,
+                                                                 cache_max_mb=job.cache_max_mb)
 
-    #extract the representative points for regions and split them into X and Y coordinates
-    shape['coords'] = shape['geometry'].apply(lambda x: x.representative_point().coords[:])
-    shape['coords'] = [coords[0] for coords in shape['coords']]
-    shape["X"], shape["Y"] = zip(*shape["coords"])
-    
-    if agg_mapinfo is None:
-        #create a Basemap instance
-        m = Basemap(projection='merc', resolution='i', area_thresh=0.1, 
-                    llcrnrlon=llcrnrlon, llcrnrlat=llcrnrlat, urcrnrlon=urcrnrlon, urcrnrlat=urcrnrlat,
-                    ax=ax)
-        m.drawcountries()
-        m.drawmapboundary(linewidth=0)
-        m.fillcontinents(color=plainmapcol)
-        m.drawcoastlines()
-        
-        #creating boundaries on simple map
-        if simple_map_boundaries:
-            m.readshapefile(os.path.join(shape_dir, base_name), base_name)
-
-        #editing metadata input data for pie chart on Map
-        region_agg2 = shape.groupby(["RGN21NM", "X", "Y"])[agg_column].value_counts().to_frame(name="Counts")
-        region_agg2 = region_agg2.reset_index()
-
-        total_counts = region_agg2.groupby("RGN21NM")["Counts"].sum()
-        region_agg2["Total cases"] = region_agg2["RGN21NM"].map(total_counts)
-
-        for (region_name, xpos, ypos), group in region_agg2.groupby(["RGN21NM", "X", "Y"]):
-            group["colours"] = group[agg_column].map(colours_dict)
-            colors = group["colours"].tolist()
-            total_cases = group["Total cases"].iloc[0]
-            num_cases = group["Counts"].tolist()
-            dist = [num / total_cases for num in num_cases]
-            tx, ty = m(xpos, ypos)
-
-            draw_pie(dist, xpos, ypos, total_cases * pie_size, colors, m, ax=ax, label_style=label_style, pie_fontsize=pie_fontsize, pie_rotation=pie_rotation, pie_text_loc=pie_text_loc)
-            
-            #setting markers for style2 of pie charts
-            if label_style == 'style2':
-                t = plt.annotate('n= {}'.format(total_cases), (tx, ty),
-                                 color='black', fontsize=20, fontweight="bold",
-                                 path_effects=[PathEffects.withStroke(linewidth=5, foreground='w')])
-
-
-            #setting legend for pies
-            legend_handles = [mlines.Line2D([], [], color=color, marker='o', linestyle='None', 
-                                        markersize=10, label=label) 
-                          for label, color in colours_dict.items()]
-            plt.legend(handles=legend_handles, title=legend_title, title_fontsize=legend_fontsize + 5, 
-                     fontsize=legend_fontsize, bbox_to_anchor=legend_bbox_to_anchor)
+    return (state["metadata"][job.metadata_file], state["boundaries"][boundaries_key],
+            state["basemaps"][corners], state["layers"][layers_key])
 
-    #code for complex map with background information (Chloropleth)
+#render one job of a batch, reusing the inputs, Basemap instances and backgrounds stored by the previous jobs
+def render_job(job, state):
+    check_options(job.label_style, job.file_format)
+    check_inputs(job.shape_file, job.metadata_file, job.colours_dict, job.colormap)
+
+    human_meta, boundaries, basemap, layers = load_job_inputs(job, state)
+    check_metadata(human_meta, job.agg_column, job.agg_mapinfo)
+
+    with map_profile.stage("merge"):
+        region_counts, region_values = aggregate_metadata(human_meta, job.agg_column, job.agg_mapinfo)
+        region_agg2, regions, job_boundaries = attach_boundaries(region_counts, boundaries)
+    value_range = None
+    if job.agg_mapinfo is not None:
+        value_range = (human_meta[job.agg_mapinfo].min(), human_meta[job.agg_mapinfo].max())
+
+    corners = (job.llcrnrlon, job.llcrnrlat, job.urcrnrlon, job.urcrnrlat)
+    resolution = pick_map_resolution(job.map_resolution, *corners)
+    simple_map = job.agg_mapinfo is None
+    outlines = simple_map and job.simple_map_boundaries
+    if simple_map:
+        outlines_key = outlines and (job.shape_file, job.clip_to_bbox, job.simplify, job.simplify and job.dpi)
+        background_key = (corners, resolution, simple_map, job.plainmapcol, outlines_key)
     else:
-        #raise error
-        if not pd.api.types.is_numeric_dtype(shape[agg_mapinfo]):
-            raise ValueError("The aggregation column for Choropleth map (Map density) must be numeric data.")
-
-        #create Background map
-        m = Basemap(projection='merc', resolution='i', area_thresh=0.1, llcrnrlon=llcrnrlon, llcrnrlat=llcrnrlat, urcrnrlon=urcrnrlon, urcrnrlat=urcrnrlat, ax=ax)
-        m.drawcountries()
-        m.drawmapboundary()
-
-        # Determine if the colormap is a custom list or a predefined palette
-        if isinstance(colormap, str):
-            cmap = cm.get_cmap(colormap, 100)
-        elif isinstance(colormap, list):
-            cmap = LinearSegmentedColormap.from_list('custom_colormap', colormap, N=100)
-        else:
-            raise ValueError("Invalid colormap format. Provide a colormap name or a list of at least two HEX colors.")
+        background_key = (corners, resolution, simple_map)
+    backgrounds = state["backgrounds"]
+    if background_key not in backgrounds:
+        with map_profile.stage("background"):
+            backgrounds[background_key] = create_background(simple_map, job.plainmapcol, layers, basemap,
+                                                            boundaries if outlines else None)
+    background = backgrounds[background_key]
+    count_geometry(regions, job_boundaries, layers)
 
-        # Normalize values for the colormap
-        norm = Normalize(vmin=shape[agg_mapinfo].min(), vmax=shape[agg_mapinfo].max())
-
-        #adjust shapefile for coordinates in both MultiPolygon and Polygon formats
-        for idx, row in shape.iterrows():
-            color = cmap(norm(row[agg_mapinfo]))
-            geom = row['geometry']
-            if isinstance(geom, Polygon):
-                geom = [geom]
-            elif isinstance(geom, MultiPolygon):
-                geom = geom.geoms
-            for poly in geom:
-                x, y = zip(*list(poly.exterior.coords))
-                mx, my = m(x, y)
-                ax.fill(mx, my, color=color)
-
-        #as previously edit metadata input data for pie chart on Map
-        region_agg2 = shape.groupby(["RGN21NM", "X", "Y"])[agg_column].value_counts().to_frame(name="Counts")
-        region_agg2 = region_agg2.reset_index()
-
-        total_counts = region_agg2.groupby("RGN21NM")["Counts"].sum()
-        region_agg2["Total cases"] = region_agg2["RGN21NM"].map(total_counts)
-
-        for (region_name, xpos, ypos), group in region_agg2.groupby(["RGN21NM", "X", "Y"]):
-            group["colours"] = group[agg_column].map(colours_dict)
-            colors = group["colours"].tolist()
-            total_cases = group["Total cases"].iloc[0]
-            num_cases = group["Counts"].tolist()
-            dist = [num / total_cases for num in num_cases]
-            tx, ty = m(xpos, ypos)
-
-            draw_pie(dist, xpos, ypos, total_cases * pie_size, colors, m, ax=ax, label_style=label_style, pie_fontsize=pie_fontsize, pie_rotation=pie_rotation, pie_text_loc=pie_text_loc)
-    
-            #setting markers for style2 of pie charts
-            if label_style == 'style2':
-                t = plt.annotate('n= {}'.format(total_cases), (tx, ty), fontsize=pie_fontsize, color="black", weight="black")
-                t.set_path_effects([PathEffects.withStroke(linewidth=5, foreground='w')])
+    #everything drawn by this job is removed afterwards, leaving the background for the next jobs
+    static_artists = set(background["ax"].get_children())
+    try:
+        draw_overlays(background, region_agg2, regions, job_boundaries, job.agg_column, job.colours_dict,
+                      region_values, value_range, job.pie_size, job.legend_title, job.colorbar_title,
+                      job.colormap, job.label_style, job.pie_fontsize, job.pie_rotation,
+                      job.legend_fontsize, job.colorbar_fontsize, job.legend_bbox_to_anchor, job.pie_text_loc)
+        save_map(background["fig"], job.output_file_prefix, job.file_format, job.dpi)
+    finally:
+        for artist in background["ax"].get_children():
+            if artist not in static_artists:
+                artist.remove()
 
-        #setting parameters for colour bar of map
-        sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
-        sm.set_array([])
-        cbar = plt.colorbar(sm, ax=ax, orientation='vertical', shrink=0.4)
-        cbar.set_label(colorbar_title, labelpad=-65, fontsize=colorbar_fontsize)
+#render a job, catching its errors so that one failed job does not stop the batch, and time it
+def run_job(number, total, job, state):
+    outputs = ", ".join(f"{job.output_file_prefix}.{file_format}" for file_format in split_formats(job.file_format))
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    error = None
+    try:
+        render_job(job, state)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    seconds = time.perf_counter() - start
 
-        #setting parameters of pie chart legend
-        legend_handles = [mlines.Line2D([], [], color=color, marker='o', linestyle='None', 
-                                        markersize=10, label=label) 
-                          for label, color in colours_dict.items()]
-        plt.legend(handles=legend_handles, title=legend_title, title_fontsize=legend_fontsize + 5, 
-                    fontsize=legend_fontsize, bbox_to_anchor=legend_bbox_to_anchor)
+    if error is None:
+        print(f"Job {number}/{total}: saved {outputs} ({seconds:.2f} s)")
+    else:
+        print(f"Job {number}/{total}: failed to render {outputs}. {error}")
+    return {"job": number, "output": outputs, "seconds": seconds, "cpu_seconds": time.process_time() - cpu_start,
+            "worker": os.getpid(), "error": error}
 
-    plt.axis("off")
-    valid_formats = ['png', 'jpeg', 'svg', 'pdf']
+#render many maps in one process, reporting the time taken by each and carrying on past failed jobs
+def render_jobs(jobs):
+    state = new_batch_state(jobs)
+    return [run_job(number, len(jobs), job, state) for number, job in enumerate(jobs, 1)]
 
-    #raise error
-    if file_format not in valid_formats:
-        raise ValueError(f"Invalid format: {file_format}. Choose from {valid_formats}.")
+#state of the batch in a worker process. Filled by the parent before the pool starts, so forked workers inherit
+#the metadata, prepared boundaries and Basemap instances instead of receiving them pickled with every job
+_batch_state = new_batch_state()
 
-    #save output
-    plt.savefig(f"{output_file_prefix}.{file_format}", format=file_format, dpi=dpi)
-    
-   #finish progress bar 
-    bar.finish()
-    plt.show()
+def run_job_in_worker(task):
+    number, total, job = task
+    return run_job(number, total, job, _batch_state)
+
+#render the jobs in a pool of worker processes, each job saving one file format
+def render_jobs_parallel(jobs, workers):
+    jobs = [job for job in jobs for job in split_jobs_by_format(job)]
+
+    #load the shared inputs once in the parent. A failing job is left to report its error from the worker
+    global _batch_state
+    _batch_state = new_batch_state(jobs)
+    for job in jobs:
+        try:
+            load_job_inputs(job, _batch_state)
+        except Exception:
+            pass
+
+    #fork shares the loaded inputs with the workers. Where it is not available, each worker loads them itself
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context()
+    tasks = [(number, len(jobs), job) for number, job in enumerate(jobs, 1)]
+    with context.Pool(processes=workers) as pool:
+        results = list(pool.imap_unordered(run_job_in_worker, tasks))
+    return sorted(results, key=lambda result: result["job"])
+
+#file formats of a comma separated --file_format value
+def split_formats(file_format):
+    return [part.strip() for part in file_format.split(",")]
+
+#one job per file format, so the formats of the same figure can be rendered by different workers
+def split_jobs_by_format(job):
+    return [argparse.Namespace(**{**vars(job), "file_format": file_format}) for file_format in split_formats(job.file_format)]
 
 if __name__ == "__main__":
     main()
-
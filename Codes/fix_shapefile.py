@@ -8,48 +8,133 @@ __author__ = 'E.F.Fotopoulou'
 
 ###### Imports
 import argparse
+import json
+import os
+import fiona
 import geopandas as gpd
+import pandas as pd
 from pyproj import CRS
 
+#output formats of the fixed file: OGR driver and file extension. GeoParquet is written with pyarrow
+OUTPUT_FORMATS = {'shp': ("ESRI Shapefile", ".shp"), 'fgb': ("FlatGeobuf", ".fgb"), 'parquet': (None, ".parquet")}
+
+#arrow types of the fiona field types, for GeoParquet output. Dates and times are kept as the text fiona reads them as
+ARROW_TYPES = {'str': 'string', 'int': 'int64', 'int32': 'int64', 'int64': 'int64', 'float': 'float64', 'bool': 'bool_',
+               'date': 'string', 'time': 'string', 'datetime': 'string'}
+
 
 def parse_args():
     description = "Fix shape file to contain column RGN21NM which will be shared in metadata file"
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('--shape_file', required=True, help="Path to shape file")
     parser.add_argument('--column', required=False, help="Column name to replace with 'RGN21NM'")
+    parser.add_argument('--output_format', choices=list(OUTPUT_FORMATS), default='shp', help="Format of the fixed file: shapefile, FlatGeobuf with a spatial index, or GeoParquet (requires pyarrow)")
+    parser.add_argument('--batch_size', type=int, default=10000, help="Number of features read, reprojected and written at a time")
     return parser.parse_args()
 
 def main():
     args = parse_args()
-    fix_shape(args.shape_file, args.column)
+    fix_shape(args.shape_file, args.column, args.output_format, args.batch_size)
 
 # Function to test if the shape file is in correct format
-def fix_shape(shapefile_path, column=None):
-    gdf = gpd.read_file(shapefile_path)
+def fix_shape(shapefile_path, column=None, output_format='shp', batch_size=10000):
+    #only the schema of the shapefile is read to check its columns
+    with fiona.open(shapefile_path) as source:
+        columns = list(source.schema["properties"])
 
     # The Geomaps_pie.py script runs with the requirement of a column named 'RGN21NM' which carries the names of the the regions to be ploted.
-    if "RGN21NM" in gdf.columns:
-        print("The 'RGN21NM' column already exists. No changes made.")
+    if "RGN21NM" in columns:
+        if output_format == 'shp':
+            print("The 'RGN21NM' column already exists. No changes made.")
+            return
+        #the file is only converted to the other format
+        column = None
     else:
         if column is None:
             # If no column is provided, just print the top 5 rows of the shapefile
             print("The 'RGN21NM' column is missing. Here are the top 5 lines of the shapefile:")
-            print(gdf.head())
+            print(gpd.read_file(shapefile_path, rows=5))
+            return
+        if column not in columns:
+            print(f"Error: Column '{column}' does not exist in the shapefile.")
+            return
+
+    # Replace the specified column with 'RGN21NM', reproject to geographic coordinates and save the fixed file
+    output_path = os.path.splitext(shapefile_path)[0] + "_fixed" + OUTPUT_FORMATS[output_format][1]
+    convert(shapefile_path, output_path, column, output_format, batch_size)
+
+    if column is None:
+        print(f"The 'RGN21NM' column already exists. Saved to {output_path}")
+    else:
+        print(f"Column '{column}' replaced with 'RGN21NM' and saved to {output_path}")
+
+#read the features batch by batch, renaming the column and reprojecting each batch before it is written,
+#so that only one batch of features is held in memory at a time
+def convert(shapefile_path, output_path, column=None, output_format='shp', batch_size=10000):
+    with fiona.open(shapefile_path) as source:
+        properties = {("RGN21NM" if name == column else name): kind for name, kind in source.schema["properties"].items()}
+        geometry_type = source.schema["geometry"]
+        batches = read_batches(source, batch_size, column)
+
+        if output_format == 'parquet':
+            write_geoparquet(output_path, batches, properties, geometry_type)
         else:
-            # Replace the specified column with 'RGN21NM'
-            if column in gdf.columns:
-                gdf = gdf.rename(columns={column: "RGN21NM"})
+            driver = OUTPUT_FORMATS[output_format][0]
+            #shapefiles mix polygons and multipolygons under one geometry type, which FlatGeobuf does not accept.
+            #FlatGeobuf has no date fields either, so dates are kept as the text fiona reads them as
+            if driver != "ESRI Shapefile":
+                geometry_type = "Unknown"
+                properties = {name: ('str' if kind.split(':')[0] in ['date', 'time', 'datetime'] else kind) for name, kind in properties.items()}
+            write_features(output_path, batches, driver, {"properties": properties, "geometry": geometry_type})
+
+#features of the shapefile as GeoDataFrames of at most batch_size rows, in geographic coordinates
+def read_batches(source, batch_size, column=None):
+    columns = list(source.schema["properties"]) + ["geometry"]
+    batch = []
+    for feature in source:
+        batch.append(feature)
+        if len(batch) == batch_size:
+            yield prepare_batch(batch, source.crs_wkt, columns, column)
+            batch = []
+    if batch:
+        yield prepare_batch(batch, source.crs_wkt, columns, column)
+
+def prepare_batch(features, crs, columns, column=None):
+    gdf = gpd.GeoDataFrame.from_features(features, crs=crs or None, columns=columns)
+    if column is not None:
+        gdf = gdf.rename(columns={column: "RGN21NM"})
+
+    # Reproject to geographic coordinates
+    return gdf.to_crs(CRS.from_epsg(4326))
+
+#write the batches with an OGR driver. FlatGeobuf files get a spatial index, used by Geomaps_pie.py to read only the features of the map
+def write_features(output_path, batches, driver, schema):
+    options = {"SPATIAL_INDEX": "YES"} if driver == "FlatGeobuf" else {}
+    with fiona.open(output_path, 'w', driver=driver, schema=schema, crs_wkt=CRS.from_epsg(4326).to_wkt(), **options) as sink:
+        for batch in batches:
+            sink.writerecords(batch.iterfeatures())
 
-                # Reproject to geographic coordinates
-                gdf = gdf.to_crs(CRS.from_epsg(4326))
+#write the batches as row groups of a GeoParquet file, the geometries encoded as WKB
+def write_geoparquet(output_path, batches, properties, geometry_type):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("Writing GeoParquet requires the pyarrow package.")
 
-                # Save the reprojected shapefile
-                output_path = shapefile_path.replace(".shp", "_fixed.shp")
-                gdf.to_file(output_path)
+    fields = [pa.field(name, getattr(pa, ARROW_TYPES.get(kind.split(':')[0], 'string'))()) for name, kind in properties.items()]
+    fields.append(pa.field("geometry", pa.binary()))
+    #polygon and line shapefiles hold the multipart geometries as well
+    geometry_types = [geometry_type, "Multi" + geometry_type] if geometry_type in ["Polygon", "LineString"] else [geometry_type]
+    geo = {"version": "0.4.0", "primary_column": "geometry",
+           "columns": {"geometry": {"encoding": "WKB", "geometry_type": geometry_types, "crs": CRS.from_epsg(4326).to_json_dict()}}}
+    schema = pa.schema(fields, metadata={"geo": json.dumps(geo)})
 
-                print(f"Column '{column}' replaced with 'RGN21NM' and saved to {output_path}")
-            else:
-                print(f"Error: Column '{column}' does not exist in the shapefile.")
+    with pq.ParquetWriter(output_path, schema) as writer:
+        for batch in batches:
+            table = pd.DataFrame(batch.drop(columns="geometry"))
+            table["geometry"] = [None if geometry is None else geometry.wkb for geometry in batch.geometry]
+            writer.write_table(pa.Table.from_pandas(table, schema=schema, preserve_index=False))
 
 if __name__ == "__main__":
     main()
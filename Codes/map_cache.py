@@ -0,0 +1,121 @@
+# On-disk cache of prepared map geometry for Geomaps_pie.py.
+# Each entry is a directory of .npy arrays named after a key built from the input file contents and the map parameters,
+# so later runs can memory-map the arrays instead of reading, reprojecting and projecting the shapefile again.
+
+__version__ = '0.1'
+__date__ = '18-10-2026'
+
+###### Imports
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+#bump when the layout of the cached arrays changes, so old entries are never read back
+CACHE_VERSION = 2
+
+#kinds of data stored in the cache, the first part of the entry names
+CACHE_KINDS = ['boundaries', 'background']
+
+#names of the cache entries, and of the temporary directories they are written into. Any other file or directory
+#of the cache directory belongs to the user and is never listed or removed
+ENTRY_NAME = re.compile(r'^(' + '|'.join(CACHE_KINDS) + r')-[0-9a-f]{32}$')
+TMP_ENTRY_NAME = re.compile(r'^\.tmp-[A-Za-z0-9_]{8}$')
+
+#files that make up a shapefile; any of them changing changes the prepared geometry
+SHAPEFILE_PARTS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+
+#content hash of an input file, together with its shapefile sidecar files when it has any
+def file_digest(path):
+    base, ext = os.path.splitext(path)
+    parts = [base + part for part in SHAPEFILE_PARTS] if ext.lower() == '.shp' else [path]
+
+    digest = hashlib.sha256()
+    for part in parts:
+        if not os.path.exists(part):
+            continue
+        digest.update(os.path.basename(part).encode())
+        with open(part, 'rb') as handle:
+            for block in iter(lambda: handle.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+#key of a cache entry: what kind of data it holds, the hash of its input files and the parameters used to prepare it
+def cache_key(kind, input_files=(), **params):
+    if kind not in CACHE_KINDS:
+        raise ValueError(f"Unknown cache entry kind: {kind}")
+    description = {
+        "version": CACHE_VERSION,
+        "kind": kind,
+        "inputs": [file_digest(path) for path in input_files],
+        "params": params,
+    }
+    return kind + "-" + hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:32]
+
+#memory-map the arrays of a cache entry, or return None when the entry does not exist
+def load_arrays(cache_dir, key):
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry):
+        return None
+
+    arrays = {}
+    for name in os.listdir(entry):
+        if name.endswith('.npy'):
+            arrays[name[:-4]] = np.load(os.path.join(entry, name), mmap_mode='r')
+
+    #mark the entry as recently used for the eviction order
+    os.utime(entry)
+    return arrays
+
+#write the arrays of a cache entry, then evict the least recently used entries beyond max_bytes
+def save_arrays(cache_dir, key, arrays, max_bytes=None):
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, key)
+
+    #write into a temporary directory first so concurrent runs never read a half written entry
+    tmp_entry = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+    os.chmod(tmp_entry, 0o755)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_entry, name + '.npy'), np.asarray(array), allow_pickle=False)
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        #another run stored the same entry in the meantime
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    if max_bytes is not None:
+        evict(cache_dir, max_bytes, keep=key)
+
+def entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+#remove the least recently used entries until the cache fits in max_bytes
+def evict(cache_dir, max_bytes, keep=None):
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if ENTRY_NAME.match(name) and os.path.isdir(entry):
+            entries.append((os.path.getmtime(entry), name, entry_size(entry)))
+
+    total = sum(size for _, _, size in entries)
+    for _, name, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        total -= size
+
+#remove every entry of the cache directory, and the temporary directories left by interrupted runs
+def clear_cache(cache_dir):
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if (ENTRY_NAME.match(name) or TMP_ENTRY_NAME.match(name)) and os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
@@ -0,0 +1,105 @@
+# Stage timing report for Geomaps_pie.py.
+# Records the wall time, CPU time and peak resident memory of the named stages of a run, together with counts
+# such as matplotlib artists and geometry vertices, and writes them as a JSON or CSV report.
+
+__version__ = '0.1'
+__date__ = '18-10-2026'
+
+###### Imports
+import contextlib
+import csv
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    #not available on Windows, where the peak memory is left out of the report
+    resource = None
+
+#report of the current run, None when the run is not profiled
+_report = None
+
+
+#peak resident memory of the process so far, in MB
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1e6 if sys.platform == 'darwin' else peak * 1024 / 1e6
+
+#start recording the stages of this run
+def start():
+    global _report
+    _report = {"stages": {}, "counts": {}, "start": (time.perf_counter(), time.process_time())}
+
+def enabled():
+    return _report is not None
+
+#record a stage of the run. Stages entered several times are added up
+@contextlib.contextmanager
+def stage(name):
+    if _report is None:
+        yield
+        return
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        record = _report["stages"].setdefault(name, {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_mb": None})
+        record["calls"] += 1
+        record["wall_seconds"] += time.perf_counter() - wall_start
+        record["cpu_seconds"] += time.process_time() - cpu_start
+        record["peak_rss_mb"] = peak_rss_mb()
+
+#add to a count of the report, such as the number of artists or vertices drawn
+def count(name, value):
+    if _report is not None:
+        _report["counts"][name] = _report["counts"].get(name, 0) + int(value)
+
+#number of artists in a figure, and of the paths and vertices they draw
+def count_figure(fig):
+    artists = fig.findobj()
+    paths = 0
+    vertices = 0
+    for artist in artists:
+        if hasattr(artist, "get_paths"):
+            artist_paths = artist.get_paths()
+        elif hasattr(artist, "get_path"):
+            artist_paths = [artist.get_path()]
+        else:
+            continue
+        paths += len(artist_paths)
+        vertices += sum(len(path.vertices) for path in artist_paths)
+    count("figure_artists", len(artists))
+    count("figure_paths", paths)
+    count("figure_vertices", vertices)
+
+#stages, counts and totals of the run
+def summary():
+    wall_start, cpu_start = _report["start"]
+    stages = [{"stage": name, **record} for name, record in _report["stages"].items()]
+    total = {"wall_seconds": time.perf_counter() - wall_start, "cpu_seconds": time.process_time() - cpu_start,
+             "peak_rss_mb": peak_rss_mb()}
+    return {"stages": stages, "counts": dict(_report["counts"]), "total": total}
+
+#write the report as JSON, or as CSV when the file name ends with .csv
+def write_report(path):
+    report = summary()
+    if not path.lower().endswith('.csv'):
+        with open(path, 'w') as handle:
+            json.dump(report, handle, indent=2)
+        return
+
+    with open(path, 'w', newline='') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["name", "calls", "wall_seconds", "cpu_seconds", "peak_rss_mb", "count"])
+        for record in report["stages"]:
+            writer.writerow([record["stage"], record["calls"], record["wall_seconds"], record["cpu_seconds"], record["peak_rss_mb"], ""])
+        writer.writerow(["total", "", report["total"]["wall_seconds"], report["total"]["cpu_seconds"], report["total"]["peak_rss_mb"], ""])
+        for name, value in report["counts"].items():
+            writer.writerow([name, "", "", "", "", value])